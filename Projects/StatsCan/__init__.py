@@ -1,20 +1,53 @@
-'''Read StatsCan Data into python, mostly pandas dataframes
-
-TODO
-----
-Logging
-
-French support
-'''
-__version__ = '2.0'
-from stats_can import sc
-from stats_can.scwds import get_changed_series_list
-from stats_can.scwds import get_changed_cube_list
-from stats_can.scwds import get_cube_metadata
-from stats_can.scwds import get_series_info_from_vector
-from stats_can.sc import table_to_df
-from stats_can.sc import update_tables
-from stats_can.sc import list_downloaded_tables
-from stats_can.sc import delete_tables
-from stats_can.sc import vectors_to_df
-from stats_can.sc import vectors_to_df_local
+'''Read StatsCan Data into python, mostly pandas dataframes
+
+Submodules and the functions below are only imported the first time they're
+used (PEP 562), so importing the package is quick and pandas, h5py and
+friends aren't loaded until something needs them.
+
+TODO
+----
+Logging
+
+French support
+'''
+import importlib
+
+__version__ = '2.0'
+
+# Public names mapped to the submodule they come from
+_LAZY_ATTRIBUTES = {
+    'get_changed_series_list': 'scwds',
+    'get_changed_cube_list': 'scwds',
+    'get_cube_metadata': 'scwds',
+    'get_series_info_from_vector': 'scwds',
+    'table_to_df': 'sc',
+    'update_tables': 'sc',
+    'list_downloaded_tables': 'sc',
+    'delete_tables': 'sc',
+    'vectors_to_df': 'sc',
+    'vectors_to_df_local': 'sc',
+}
+_SUBMODULES = ['sc', 'scwds', 'helpers', 'replay', 'benchmark', 'checks']
+
+__all__ = list(_LAZY_ATTRIBUTES) + ['sc']
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        value = importlib.import_module('stats_can.' + name)
+    elif name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(
+            'stats_can.' + _LAZY_ATTRIBUTES[name]
+            )
+        value = getattr(module, name)
+    else:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name)
+            )
+    # Later lookups find it directly and skip __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES) | set(_SUBMODULES))
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""Throughput benchmarks for the stats_can pipeline
+
+Meant to run offline against recordings made with replay.recording_session,
+so numbers are comparable between runs and don't depend on StatsCan. Every
+benchmark returns a dict of measurements, run_benchmarks runs the lot.
+
+Record the inputs once:
+    set_session(recording_session('recordings'))
+    run_benchmarks(vectors, tables)
+
+Then benchmark against the recordings:
+    run_benchmarks(vectors, tables, recordings='recordings', latency=0.05)
+
+Each benchmark works in a fresh temporary directory unless given a path, so
+local caches from earlier runs don't flatter the results. The shared
+download cache is turned off while downloads are timed and for the whole of
+run_benchmarks, see download_cache_off.
+"""
+import os
+import sys
+import time
+import subprocess
+import shutil
+import tempfile
+import itertools
+from contextlib import contextmanager
+# Run with %run -i the sc module's settings are this module's globals
+sc_module = None
+try:
+    from . import sc as sc_module
+    from .scwds import vector_chunks
+    from .scwds import get_session, set_session
+    from .scwds import get_data_from_vectors_and_latest_n_periods
+    from .sc import download_tables, zip_table_to_dataframe
+    from .sc import tables_to_h5, table_to_df, vectors_to_df_local
+    from .sc import ZIP_READ_CHUNK_ROWS
+    from .sc import table_from_h5, compact_h5, TABLE_CACHE
+    from .replay import replay_session
+except ImportError:  # run with %run -i after the other modules
+    pass
+
+# Modules importing the package shouldn't load, see benchmark_import
+HEAVY_MODULES = [
+    'pandas', 'numpy', 'h5py', 'tables', 'pyarrow', 'requests', 'urllib3'
+    ]
+# Settings compared by benchmark_h5_compression
+COMPRESSION_SETTINGS = [
+    {'complib': 'zlib', 'complevel': 1},
+    {'complib': 'zlib', 'complevel': 5},
+    {'complib': 'blosc:lz4', 'complevel': 5},
+    {'complib': 'blosc:zstd', 'complevel': 5},
+    {'complib': 'blosc:blosclz', 'complevel': 5}
+    ]
+
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import stats_can
+seconds = time.perf_counter() - start
+for name in stats_can.__all__:
+    getattr(stats_can, name)
+resolve_seconds = time.perf_counter() - start - seconds
+heavy = [m for m in sys.argv[1:] if m in sys.modules]
+print(seconds, resolve_seconds, *heavy)
+"""
+
+
+@contextmanager
+def download_cache_off():
+    """Turn off the download cache, so downloads are timed rather than
+    links from the cache, and benchmarks don't fill the user's cache"""
+    settings = vars(sc_module) if sc_module is not None else globals()
+    previous = settings['DOWNLOAD_CACHE_DIR']
+    settings['DOWNLOAD_CACHE_DIR'] = None
+    try:
+        yield
+    finally:
+        settings['DOWNLOAD_CACHE_DIR'] = previous
+
+
+def benchmark_import(repeat=5, max_seconds=None):
+    """Time importing the package in fresh interpreters
+
+    Also a regression check on the lazy imports: importing stats_can and
+    resolving each of its public names should work, and shouldn't load any
+    of HEAVY_MODULES.
+
+    Parameters
+    ----------
+    repeat: int, default 5
+        interpreters to start, the fastest import is reported
+    max_seconds: float, optional, default None
+        fail if the fastest import takes longer than this
+
+    Returns
+    -------
+    dict
+        fastest import in seconds, fastest time to then resolve the public
+        names and any heavy modules they loaded
+
+    Raises
+    ------
+    AssertionError
+        if a heavy module was loaded or the import took over max_seconds
+    subprocess.CalledProcessError
+        if a public name couldn't be imported
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    times = []
+    resolve_times = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT] + HEAVY_MODULES,
+            env=env, check=True, capture_output=True, text=True
+            ).stdout.split()
+        times.append(float(output[0]))
+        resolve_times.append(float(output[1]))
+        heavy = output[2:]
+    result = {
+        'seconds': min(times),
+        'resolve_seconds': min(resolve_times),
+        'heavy_modules_loaded': heavy
+        }
+    assert not heavy, 'import stats_can loaded ' + ', '.join(heavy)
+    if max_seconds is not None:
+        assert result['seconds'] <= max_seconds, (
+            'import stats_can took {:.3f}s'.format(result['seconds'])
+            )
+    return result
+
+
+def benchmark_vector_pull(vectors, periods=1, max_in_flight=None):
+    """Time pulling the latest periods for a list of vectors
+
+    Parameters
+    ----------
+    vectors: list of str
+        vectors to pull
+    periods: int, default 1
+        number of periods to pull for each vector
+    max_in_flight: int, optional, default None
+        chunks to request at once, see scwds.dispatch_vectors
+
+    Returns
+    -------
+    dict
+        seconds taken, requests per second and vectors per second
+    """
+    n_requests = len(vector_chunks(vectors))
+    start = time.perf_counter()
+    result = get_data_from_vectors_and_latest_n_periods(
+        vectors, periods, max_in_flight=max_in_flight
+        )
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'requests_per_second': n_requests / seconds,
+        'vectors_per_second': len(result) / seconds
+        }
+
+
+def benchmark_download(tables, path=None, max_in_flight=1):
+    """Time downloading full table zips
+
+    Parameters
+    ----------
+    tables: list of str
+        tables to download
+    path: str or path, optional, default None
+        where to download to, a temporary directory if None
+    max_in_flight: int, default 1
+        tables to download at once, see download_tables
+
+    Returns
+    -------
+    dict
+        seconds taken, megabytes downloaded and megabytes per second
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        with download_cache_off():
+            start = time.perf_counter()
+            downloaded = download_tables(
+                tables, path=work_dir, max_in_flight=max_in_flight
+                )
+            seconds = time.perf_counter() - start
+        size = sum(
+            os.path.getsize(os.path.join(work_dir, t + '-eng.zip'))
+            for t in downloaded
+            )
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+    megabytes = size / 1e6
+    return {
+        'seconds': seconds,
+        'megabytes': megabytes,
+        'megabytes_per_second': megabytes / seconds
+        }
+
+
+def benchmark_zip_parse(table, path=None, chunksize=None):
+    """Time reading a zipped table into a DataFrame
+
+    Parameters
+    ----------
+    table: str
+        table to read, downloaded first if it isn't in path
+    path: str or path, optional, default None
+        where the zip is, a temporary directory if None
+    chunksize: int, optional, default None
+        rows per chunk, see zip_table_to_dataframe
+
+    Returns
+    -------
+    dict
+        seconds taken, rows read and rows per second
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        download_tables([table], path=work_dir)
+        start = time.perf_counter()
+        df = zip_table_to_dataframe(table, path=work_dir, chunksize=chunksize)
+        seconds = time.perf_counter() - start
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+    return {
+        'seconds': seconds,
+        'rows': len(df),
+        'rows_per_second': len(df) / seconds
+        }
+
+
+def benchmark_tables_to_h5(table, path=None, h5file='stats_can.h5'):
+    """Time parsing a downloaded table and writing it to a store
+
+    Parameters
+    ----------
+    table: str
+        table to store, downloaded first so only parse and write are timed
+    path: str or path, optional, default None
+        where to put the store, a temporary directory if None
+    h5file: str, default stats_can.h5
+        name of the store
+
+    Returns
+    -------
+    dict
+        seconds taken, rows written and rows per second
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        download_tables([table], path=work_dir)
+        start = time.perf_counter()
+        tables_to_h5([table], h5file=h5file, path=work_dir)
+        seconds = time.perf_counter() - start
+        rows = len(table_to_df(table, path=work_dir, h5file=h5file))
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+    return {
+        'seconds': seconds,
+        'rows': rows,
+        'rows_per_second': rows / seconds
+        }
+
+
+def benchmark_vectors_to_df_local(
+    vectors, path=None, h5file='stats_can.h5', repeat=5, **kwargs
+):
+    """Time local vector queries once their tables are stored
+
+    The first call, which downloads and stores the tables, isn't timed.
+
+    Parameters
+    ----------
+    vectors: list of str
+        vectors to query
+    path: str or path, optional, default None
+        where the store is, a temporary directory if None
+    h5file: str, default stats_can.h5
+        name of the store
+    repeat: int, default 5
+        number of timed queries
+    **kwargs
+        passed on to vectors_to_df_local
+
+    Returns
+    -------
+    dict
+        fastest, median and slowest query in seconds
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        vectors_to_df_local(vectors, path=work_dir, h5file=h5file, **kwargs)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            vectors_to_df_local(
+                vectors, path=work_dir, h5file=h5file, **kwargs
+                )
+            times.append(time.perf_counter() - start)
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+    times.sort()
+    return {
+        'min_seconds': times[0],
+        'median_seconds': times[len(times) // 2],
+        'max_seconds': times[-1]
+        }
+
+
+def benchmark_h5_compression(
+    table, settings=None, chunkshapes=(None,), path=None, repeat=3
+):
+    """Compare compression settings for a stored table
+
+    The table is stored once uncompressed, then for each setting the store
+    is rewritten with compact_h5 and read back with table_from_h5. Writing
+    is timed over the rewrite, so it includes reading the uncompressed copy.
+    Reads skip the in memory table cache.
+
+    Parameters
+    ----------
+    table: str
+        table to store, downloaded first unless its zip and json are already
+        in path
+    settings: list of dict, optional, default None
+        complib and complevel to try, COMPRESSION_SETTINGS if None
+    chunkshapes: list of int, default (None,)
+        rows per HDF5 chunk to try each setting with, None lets PyTables
+        pick
+    path: str or path, optional, default None
+        where to put the stores, a temporary directory if None
+    repeat: int, default 3
+        timed reads per setting, the fastest is reported
+
+    Returns
+    -------
+    results: list of dict
+        the complib, complevel and chunkshape tried, with the file's
+        megabytes, write and read rows per second
+    """
+    work_dir = path or tempfile.mkdtemp()
+    base = 'compression_base.h5'
+    trial = 'compression_trial.h5'
+    results = []
+    try:
+        tables_to_h5([table], h5file=base, path=work_dir, complevel=0)
+        rows = len(table_from_h5(table, h5file=base, path=work_dir))
+        for setting, chunkshape in itertools.product(
+            settings or COMPRESSION_SETTINGS, chunkshapes
+        ):
+            shutil.copy(
+                os.path.join(work_dir, base), os.path.join(work_dir, trial)
+                )
+            start = time.perf_counter()
+            compact_h5(
+                trial, path=work_dir, complib=setting['complib'],
+                complevel=setting['complevel'], chunkshape=chunkshape
+                )
+            write_seconds = time.perf_counter() - start
+            read_times = []
+            for _ in range(repeat):
+                TABLE_CACHE.clear()
+                start = time.perf_counter()
+                table_from_h5(table, h5file=trial, path=work_dir)
+                read_times.append(time.perf_counter() - start)
+            size = os.path.getsize(os.path.join(work_dir, trial))
+            results.append({
+                'complib': setting['complib'],
+                'complevel': setting['complevel'],
+                'chunkshape': chunkshape,
+                'megabytes': size / 1e6,
+                'write_rows_per_second': rows / write_seconds,
+                'read_rows_per_second': rows / min(read_times)
+                })
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+    return results
+
+
+def run_benchmarks(
+    vectors, tables, recordings=None, latency=0, bandwidth=None,
+    max_in_flight=4
+):
+    """Run every benchmark, replaying recorded api responses if given
+
+    Parameters
+    ----------
+    vectors: list of str
+        vectors for the vector pull and local query benchmarks
+    tables: list of str
+        tables for the download benchmark, the first is also parsed and
+        stored
+    recordings: str or path, optional, default None
+        directory of recordings to replay, None to use the current session
+    latency: float, default 0
+        seconds of simulated latency per request when replaying
+    bandwidth: float, optional, default None
+        simulated bytes per second when replaying
+    max_in_flight: int, default 4
+        concurrency for the concurrent variants of the benchmarks
+
+    Returns
+    -------
+    results: dict
+        benchmark name mapped to its measurements
+    """
+    previous_session = get_session()
+    if recordings:
+        set_session(replay_session(recordings, latency, bandwidth))
+    try:
+        with download_cache_off():
+            results = {
+                'import': benchmark_import(),
+                'vector_pull_serial': benchmark_vector_pull(
+                    vectors, max_in_flight=1
+                    ),
+                'vector_pull_concurrent': benchmark_vector_pull(
+                    vectors, max_in_flight=max_in_flight
+                    ),
+                'download_serial': benchmark_download(tables),
+                'download_concurrent': benchmark_download(
+                    tables, max_in_flight=max_in_flight
+                    ),
+                'zip_parse': benchmark_zip_parse(tables[0]),
+                'zip_parse_chunked': benchmark_zip_parse(
+                    tables[0], chunksize=ZIP_READ_CHUNK_ROWS
+                    ),
+                'tables_to_h5': benchmark_tables_to_h5(tables[0]),
+                'h5_compression': benchmark_h5_compression(tables[0]),
+                'vectors_to_df_local': benchmark_vectors_to_df_local(vectors)
+                }
+    finally:
+        set_session(previous_session)
+    return results
@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+"""Offline checks of the local stores
+
+Each check builds a small synthetic table in a temporary directory, runs it
+through the same code the package uses on real tables, and raises
+AssertionError if something is off. Nothing goes to StatsCan, so they run
+anywhere the dependencies are installed.
+
+    run_checks()
+"""
+import os
+import io
+import csv
+import json
+import shutil
+import zipfile
+import time
+import tempfile
+import threading
+import requests
+try:
+    from .sc import tables_to_h5, table_from_h5, h5_copy_tables
+    from .sc import h5_catalog, h5_apply_changed_data
+    from .sc import h5_access_times, h5_space_usage, compact_h5
+    from .sc import delete_tables, aggregate_table
+    from .sc import download_cache_add, download_cache_get
+    from .sc import download_cache_files, download_cache_prune
+    from .sc import download_file, h5_data_columns, LazyTable
+    from .replay import replay_session, request_key
+    from .benchmark import benchmark_h5_compression
+    from .scwds import CONTROLLER, dispatch_vectors
+except ImportError:  # run with %run -i after the other modules
+    pass
+
+SAMPLE_TABLE = '12345678'
+
+
+def make_sample_table(
+    path, table=SAMPLE_TABLE, n_vectors=20, n_periods=24,
+    cube_end_date='2020-12-01', release_time='2021-01-05T08:30'
+):
+    """Write a zip and json shaped like a StatsCan full table download
+
+    Parameters
+    ----------
+    path: str or path
+        where to write them
+    table: str, default SAMPLE_TABLE
+        productId to give the table
+    n_vectors: int, default 20
+        series in the table, named v1000 up
+    n_periods: int, default 24
+        monthly periods per series, from January 2019
+    cube_end_date: str, default 2020-12-01
+        cubeEndDate for the metadata
+    release_time: str, default 2021-01-05T08:30
+        releaseTime for the metadata
+
+    Returns
+    -------
+    metadata: dict
+        the table's json metadata
+    """
+    columns = [
+        'REF_DATE', 'GEO', 'DGUID', 'Sex', 'UOM', 'UOM_ID', 'SCALAR_FACTOR',
+        'SCALAR_ID', 'VECTOR', 'COORDINATE', 'VALUE', 'STATUS', 'SYMBOL',
+        'TERMINATED', 'DECIMALS'
+        ]
+    geos = ['Canada', 'Ontario', 'Quebec', 'Alberta']
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for vector in range(n_vectors):
+        for period in range(n_periods):
+            writer.writerow([
+                '{}-{:02d}'.format(2019 + period // 12, period % 12 + 1),
+                geos[vector % len(geos)], '2016A000011124',
+                'Males' if vector % 2 else 'Females', 'Dollars', '81',
+                'units', '0', 'v{}'.format(1000 + vector),
+                '{}.{}'.format(vector % len(geos) + 1, vector // 4 + 1),
+                float(vector * 100 + period), '', '', '', '1'
+                ])
+    zip_file = os.path.join(path, table + '-eng.zip')
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as myzip:
+        myzip.writestr(table + '.csv', text.getvalue())
+    metadata = {
+        'productId': table,
+        'cubeEndDate': cube_end_date,
+        'releaseTime': release_time,
+        'dimension': [
+            {'dimensionNameEn': 'Geography'}, {'dimensionNameEn': 'Sex'}
+            ]
+        }
+    with open(os.path.join(path, table + '.json'), 'w') as outfile:
+        json.dump(metadata, outfile)
+    return metadata
+
+
+def check_h5_tables_copy(path=None):
+    """Tables written by tables_to_h5 can be re-indexed and copied
+
+    PyTables keeps its own attributes on tables and their indexes, which
+    break if the nodes are copied with anything but PyTables.
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        make_sample_table(work_dir)
+        tables_to_h5([SAMPLE_TABLE], path=work_dir)
+        h5file = os.path.join(work_dir, 'stats_can.h5')
+        copied = os.path.join(work_dir, 'copied.h5')
+        h5_copy_tables(h5file, copied, ['table_' + SAMPLE_TABLE])
+        assert len(table_from_h5(SAMPLE_TABLE, h5file=copied)) == 480
+        # Loading the table again replaces it in the store
+        make_sample_table(work_dir)
+        tables_to_h5([SAMPLE_TABLE], path=work_dir)
+        h5_copy_tables(
+            h5file, os.path.join(work_dir, 'copied_again.h5'),
+            ['table_' + SAMPLE_TABLE]
+            )
+        entries = h5_catalog(path=work_dir)
+        assert [e['rows'] for e in entries] == [480], entries
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def check_h5_writes_in_place(path=None):
+    """Writing tables changes the store in place rather than copying it
+
+    Nothing to write doesn't touch the store at all.
+    """
+    work_dir = path or tempfile.mkdtemp()
+    other_table = '12345679'
+    try:
+        make_sample_table(work_dir)
+        tables_to_h5([SAMPLE_TABLE], path=work_dir)
+        h5file = os.path.join(work_dir, 'stats_can.h5')
+        before = os.stat(h5file)
+        assert tables_to_h5([], path=work_dir) == []
+        assert os.stat(h5file).st_mtime_ns == before.st_mtime_ns
+        make_sample_table(work_dir, other_table)
+        tables_to_h5([other_table], path=work_dir)
+        delete_tables([other_table], path=work_dir)
+        assert os.stat(h5file).st_ino == before.st_ino
+        assert [e['productId'] for e in h5_catalog(path=work_dir)] == [
+            SAMPLE_TABLE
+            ]
+        leftovers = [f for f in os.listdir(work_dir) if 'staging' in f]
+        assert not leftovers, leftovers
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def check_h5_delta_update(path=None):
+    """Delta updates upsert into a tables_to_h5 store, or leave it alone
+
+    A revised value replaces the stored one, a new period is added, and the
+    metadata and catalog follow, all in place. An update that fails part
+    way through leaves the data, metadata and catalog as they were.
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        metadata = make_sample_table(work_dir)
+        tables_to_h5([SAMPLE_TABLE], path=work_dir)
+        inode = os.stat(os.path.join(work_dir, 'stats_can.h5')).st_ino
+        new_metadata = dict(
+            metadata, cubeEndDate='2021-01-01',
+            releaseTime='2021-02-05T08:30'
+            )
+
+        def series(vector, ref_per, value):
+            return {
+                'vectorId': vector,
+                'vectorDataPoint': [{'refPer': ref_per, 'value': value}]
+                }
+
+        # A value that can't be stored makes the append fail
+        try:
+            h5_apply_changed_data(
+                SAMPLE_TABLE,
+                [series(1000, '2019-03-01', 1.5),
+                 series(1001, '2021-01-01', 'not a number')],
+                new_metadata, path=work_dir
+                )
+        except (ValueError, TypeError):
+            pass
+        else:
+            raise AssertionError('bad update was applied')
+        df = table_from_h5(
+            SAMPLE_TABLE, path=work_dir, where="VECTOR in ['v1000']",
+            columns=['REF_DATE', 'VECTOR', 'VALUE']
+            )
+        assert len(df) == 24 and 1.5 not in df['VALUE'].values
+        entry, = h5_catalog(path=work_dir)
+        assert entry['rows'] == 480 and entry['cubeEndDate'] == '2020-12-01'
+        # A series the table doesn't have means a full reload instead
+        assert not h5_apply_changed_data(
+            SAMPLE_TABLE, [series(9999, '2019-03-01', 1.0)], new_metadata,
+            path=work_dir
+            )
+        assert h5_apply_changed_data(
+            SAMPLE_TABLE,
+            [series(1000, '2019-03-01', 1.5),
+             series(1001, '2021-01-01', 2.5)],
+            new_metadata, path=work_dir
+            )
+        df = table_from_h5(
+            SAMPLE_TABLE, path=work_dir,
+            where="VECTOR in ['v1000', 'v1001']",
+            columns=['REF_DATE', 'VECTOR', 'VALUE']
+            )
+        values = df.set_index(['VECTOR', 'REF_DATE'])['VALUE']
+        assert len(df) == 49
+        assert values[('v1000', '2019-03-01')] == 1.5
+        assert values[('v1001', '2021-01-01')] == 2.5
+        entry, = h5_catalog(path=work_dir)
+        assert entry['rows'] == 481 and entry['cubeEndDate'] == '2021-01-01'
+        assert os.stat(os.path.join(work_dir, 'stats_can.h5')).st_ino == inode
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def check_h5_reads_dont_write(path=None):
+    """Reading a table leaves the store file alone
+
+    Last access times are kept beside the store, so reads only need the
+    shared lock and work on stores the user can't write to.
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        make_sample_table(work_dir)
+        tables_to_h5([SAMPLE_TABLE], path=work_dir)
+        h5file = os.path.join(work_dir, 'stats_can.h5')
+        before = os.stat(h5file)
+        entry, = h5_catalog(path=work_dir)
+        assert entry['lastAccess'] == entry['lastWrite']
+        table_from_h5(SAMPLE_TABLE, path=work_dir)
+        # Served from the in memory cache the second time
+        table_from_h5(SAMPLE_TABLE, path=work_dir)
+        after = os.stat(h5file)
+        assert (after.st_mtime_ns, after.st_size) == (
+            before.st_mtime_ns, before.st_size
+            )
+        assert SAMPLE_TABLE in h5_access_times(h5file)
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def check_h5_compaction(path=None):
+    """Only space given up by replaced or deleted tables counts as dead
+
+    A fresh store has no dead space, reloading or deleting a table adds
+    what it took, and compacting gives that back and leaves the remaining
+    tables readable.
+    """
+    work_dir = path or tempfile.mkdtemp()
+    other_table = '12345679'
+    try:
+        make_sample_table(work_dir)
+        make_sample_table(work_dir, other_table)
+        tables_to_h5([SAMPLE_TABLE, other_table], path=work_dir)
+        usage = h5_space_usage(path=work_dir)
+        assert usage['dead_bytes'] == 0, usage
+        entries = {e['productId']: e for e in h5_catalog(path=work_dir)}
+        make_sample_table(work_dir)
+        tables_to_h5([SAMPLE_TABLE], path=work_dir)
+        delete_tables([other_table], path=work_dir)
+        usage = h5_space_usage(path=work_dir)
+        assert usage['dead_bytes'] == (
+            entries[SAMPLE_TABLE]['bytes'] + entries[other_table]['bytes']
+            ), usage
+        result = compact_h5(path=work_dir)
+        assert result['reclaimed_bytes'] > 0, result
+        assert h5_space_usage(path=work_dir)['dead_bytes'] == 0
+        assert len(table_from_h5(SAMPLE_TABLE, path=work_dir)) == 480
+        assert [e['productId'] for e in h5_catalog(path=work_dir)] == [
+            SAMPLE_TABLE
+            ]
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def check_aggregate_chunks(path=None):
+    """Aggregating a table gives the same groups whatever the block size
+
+    Categorical columns have every category in every block, so groups must
+    only be the combinations actually seen.
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        make_sample_table(work_dir)
+        tables_to_h5([SAMPLE_TABLE], path=work_dir)
+        results = [
+            aggregate_table(
+                SAMPLE_TABLE, by=['GEO', 'Sex'], path=work_dir,
+                chunksize=chunksize
+                )
+            for chunksize in [50, 480]
+            ]
+        assert results[0].equals(results[1]), results
+        assert (results[0]['count'] > 0).all(), results[0]
+        assert results[0]['count'].sum() == 480
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def check_download_cache_prune(path=None):
+    """The download cache drops its least recently used zips to fit
+
+    Downloads linked from the cache stay where they are.
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        cache_dir = os.path.join(work_dir, 'cache')
+        sizes = {}
+        for n, key in enumerate(['used', 'old', 'new']):
+            file_name = os.path.join(work_dir, key + '.zip')
+            with open(file_name, 'wb') as outfile:
+                outfile.write(key.encode() * 1000)
+            download_cache_add(key, file_name, cache_dir)
+            sizes[key] = os.path.getsize(file_name)
+            index_file, _ = download_cache_files(key, cache_dir=cache_dir)
+            os.utime(index_file, (n, n))
+        assert download_cache_get(
+            'used', os.path.join(work_dir, 'got.zip'), cache_dir
+            )
+        removed = download_cache_prune(
+            sizes['used'] + sizes['new'], cache_dir
+            )
+        assert removed == sizes['old'], removed
+        got = os.path.join(work_dir, 'got.zip')
+        assert download_cache_get('old', got, cache_dir) is None
+        assert download_cache_get('used', got, cache_dir)
+        assert download_cache_get('new', got, cache_dir)
+        # Pruning everything, say from another thread, leaves downloads be
+        download_cache_prune(0, cache_dir)
+        for key, size in sizes.items():
+            file_name = os.path.join(work_dir, key + '.zip')
+            assert os.path.getsize(file_name) == size, key
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def check_download_resume(path=None):
+    """Partial downloads only resume if the file is the one they started
+
+    Served from a hand made recording with an ETag. A part file with the
+    matching ETag gets the rest of the file, one from an older version of
+    the file, or with no ETag recorded, is downloaded again in full. A
+    server that only answers with the wrong range is given up on.
+    """
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        url = 'https://example.com/table.zip'
+        body = bytes(range(256)) * 64
+        recordings = os.path.join(work_dir, 'recordings')
+        os.makedirs(recordings)
+        session = replay_session(recordings)
+        key = request_key(session.prepare_request(
+            requests.Request('GET', url)
+            ))
+        with open(os.path.join(recordings, key + '.body'), 'wb') as outfile:
+            outfile.write(body)
+        with open(os.path.join(recordings, key + '.json'), 'w') as outfile:
+            json.dump(
+                {'method': 'GET', 'url': url, 'status_code': 200,
+                 'reason': 'OK', 'headers': {'ETag': '"v2"'}}, outfile
+                )
+        file_name = os.path.join(work_dir, 'table.zip')
+        for validator, part in [
+            ('"v2"', body[:1000]), ('"v1"', b'x' * 1000), (None, b'x' * 1000)
+        ]:
+            with open(file_name + '.part', 'wb') as outfile:
+                outfile.write(part)
+            if validator:
+                with open(file_name + '.part.validator', 'w') as outfile:
+                    outfile.write(validator)
+            download_file(url, file_name, session=session)
+            with open(file_name, 'rb') as f_name:
+                assert f_name.read() == body, validator
+            assert not os.path.exists(file_name + '.part.validator')
+        # A server that keeps sending the wrong range is given up on
+        with open(os.path.join(recordings, key + '.json'), 'w') as outfile:
+            json.dump(
+                {'method': 'GET', 'url': url, 'status_code': 206,
+                 'reason': 'Partial Content',
+                 'headers': {'Content-Range': 'bytes 5-9/10'}}, outfile
+                )
+        os.remove(file_name)
+        try:
+            download_file(url, file_name, session=session, retries=2)
+        except requests.exceptions.RetryError:
+            pass
+        else:
+            raise AssertionError('wrong ranges were accepted')
+        assert not os.path.exists(file_name)
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def check_compression_benchmark(path=None):
+    """benchmark_h5_compression runs through on a table already on disk"""
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        make_sample_table(work_dir)
+        results = benchmark_h5_compression(
+            SAMPLE_TABLE, settings=[{'complib': 'blosc:lz4', 'complevel': 5}],
+            chunkshapes=(None, 100), path=work_dir, repeat=1
+            )
+        assert [r['chunkshape'] for r in results] == [None, 100], results
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def check_vector_chunks_adapt():
+    """Vectors are re-chunked as the controller's chunk size changes
+
+    Without a max_in_flight, up to the controller's max_concurrency chunks
+    are handed to it at once.
+    """
+    vectors = ['v{}'.format(v) for v in range(1, 5001)]
+    chunk_size = CONTROLLER.chunk_size
+    lock = threading.Lock()
+    try:
+        for max_in_flight in [1, 3, None]:
+            CONTROLLER.chunk_size = 300
+            sizes = []
+            in_flight = [0, 0]
+
+            def post_chunk(chunk):
+                with lock:
+                    sizes.append(len(chunk))
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                time.sleep(0.01)
+                CONTROLLER.chunk_size = 25
+                with lock:
+                    in_flight[0] -= 1
+                return chunk
+
+            result = dispatch_vectors(post_chunk, vectors, max_in_flight)
+            limit = max_in_flight or CONTROLLER.max_concurrency
+            assert result == list(range(1, 5001)), max_in_flight
+            assert sizes.count(300) <= limit, sizes
+            assert 25 in sizes, sizes
+            assert 1 < in_flight[1] <= limit or limit == 1, in_flight
+    finally:
+        CONTROLLER.chunk_size = chunk_size
+
+
+def check_lazy_h5_filters(path=None):
+    """Filters on a table's data columns, GEO included, select rows in h5"""
+    work_dir = path or tempfile.mkdtemp()
+    try:
+        make_sample_table(work_dir)
+        tables_to_h5([SAMPLE_TABLE], path=work_dir)
+        assert 'GEO' in h5_data_columns(SAMPLE_TABLE, path=work_dir)
+        df = (
+            LazyTable(SAMPLE_TABLE, path=work_dir)
+            .filter('GEO', ['Ontario', 'Quebec'])
+            .dates(start='2020-01-01')
+            .compute()
+            )
+        assert len(df) == 120, len(df)
+        assert set(df['GEO']) == {'Ontario', 'Quebec'}
+    finally:
+        if path is None:
+            shutil.rmtree(work_dir)
+
+
+def run_checks():
+    """Run every check, raising AssertionError on the first failure"""
+    check_h5_tables_copy()
+    check_h5_writes_in_place()
+    check_h5_delta_update()
+    check_h5_reads_dont_write()
+    check_h5_compaction()
+    check_aggregate_chunks()
+    check_download_cache_prune()
+    check_download_resume()
+    check_compression_benchmark()
+    check_vector_chunks_adapt()
+    check_lazy_h5_filters()
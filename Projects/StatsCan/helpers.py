@@ -1,5 +1,57 @@
 """Helper functions that shouldn't need to be directly called by an end user"""
 import re
+import sys
+import time
+import logging
+import importlib
+import threading
+import datetime as dt
+from collections import OrderedDict
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of vectors per api call, the api allows up to 300
+MAX_CHUNK = 250
+# Responses that mean the server wants us to slow down
+THROTTLE_STATUSES = (429, 503)
+# Where stage measurements go, see set_metrics_sink
+METRICS_SINK = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+class LazyModule:
+    """Stand-in for a module that imports it the first time it's used
+
+    Lets modules with heavy dependencies be imported quickly, the cost is
+    paid by the first function that needs them. A missing module raises
+    ImportError at that point rather than at import.
+
+    Parameters
+    ----------
+    name : str
+        full name of the module, e.g. 'pyarrow.parquet'
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return '<LazyModule {!r}>'.format(self._name)
 
 
 def check_status(results):
@@ -82,22 +134,474 @@ def parse_vectors(vectors):
     return [parse_vector(v) for v in vectors]
 
 
-def chunk_vectors(vectors):
+def chunk_vectors(vectors, chunk_size=None):
     """api calls max out at 300 vectors so break list into chunks
 
     Parameters
     ----------
     vectors : list of str or str
         A string or list of strings of vector names to be parsed
+    chunk_size : int, optional, default None
+        vectors per chunk, defaults to MAX_CHUNK
 
     Returns
     -------
     list of lists of str
         lists of vectors in chunks
     """
-    MAX_CHUNK = 250
+    chunk_size = chunk_size or MAX_CHUNK
     vectors = parse_vectors(vectors)
     chunks = [
-        vectors[i:i + MAX_CHUNK] for i in range(0, len(vectors), MAX_CHUNK)
+        vectors[i:i + chunk_size] for i in range(0, len(vectors), chunk_size)
         ]
-    return chunks
\ No newline at end of file
+    return chunks
+
+
+def dispatch_chunks(func, chunks, max_in_flight=1):
+    """Call func on every chunk, optionally with several calls in flight
+
+    Parameters
+    ----------
+    func : callable
+        function taking one chunk and returning a list of results
+    chunks : list
+        chunks to pass to func, typically the output of chunk_vectors
+    max_in_flight : int, default 1
+        most calls to have running at once, 1 runs them one after another
+
+    Returns
+    -------
+    list
+        results of every call joined together in the same order as chunks
+    """
+    if max_in_flight <= 1 or len(chunks) <= 1:
+        results = [func(chunk) for chunk in chunks]
+    else:
+        workers = min(max_in_flight, len(chunks))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map hands back results in submission order
+            results = list(executor.map(func, chunks))
+    final_list = []
+    for result in results:
+        final_list += result
+    return final_list
+
+
+def dispatch_adaptive(func, vectors, chunk_size, max_in_flight=1):
+    """Call func on chunks of vectors cut to size as they're sent
+
+    Like dispatch_chunks, except chunk_size is asked for the size of each
+    chunk just before it's sent, so a size that adapts as responses come
+    back applies to the rest of the vectors rather than from the next call.
+
+    Parameters
+    ----------
+    func : callable
+        function taking one chunk and returning a list of results
+    vectors : list of str or str
+        vectors to split up, parsed with parse_vectors
+    chunk_size : callable
+        returns the number of vectors for the next chunk, None for MAX_CHUNK
+    max_in_flight : int, default 1
+        most calls to have running at once, 1 runs them one after another
+
+    Returns
+    -------
+    list
+        results of every call joined together in the same order as vectors
+    """
+    vectors = parse_vectors(vectors)
+    max_in_flight = max(1, max_in_flight)
+    final_list = []
+    sent = 0
+    pending = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while sent < len(vectors) or pending:
+            while sent < len(vectors) and len(pending) < max_in_flight:
+                size = chunk_size() or MAX_CHUNK
+                chunk = vectors[sent:sent + size]
+                sent += len(chunk)
+                pending.append(executor.submit(func, chunk))
+            # Oldest first keeps the results in order
+            final_list += pending.pop(0).result()
+    return final_list
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header
+
+    Parameters
+    ----------
+    value : str or None
+        header value, either a number of seconds or an HTTP date
+
+    Returns
+    -------
+    float or None
+        seconds to wait, None if there's no usable value
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = dt.datetime.now(retry_at.tzinfo)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+class AdaptiveController:
+    """Adapt vector chunk size and request concurrency to the server
+
+    Requests run inside slot(), which holds them back while the concurrency
+    limit is reached or a Retry-After pause is in effect, and report their
+    outcome with record(). Throttled responses (429 or 503, including ones
+    retried away by the session) halve the concurrency and chunk size and
+    pause every request, for Retry-After seconds if the server sent it.
+    Slow responses shrink them a little. A round of fast responses grows
+    them again, so bulk pulls settle near what the server will take.
+
+    Parameters
+    ----------
+    chunk_size : int, default MAX_CHUNK
+        starting number of vectors per request
+    min_chunk_size : int, default 25
+        smallest chunk size to shrink to
+    max_chunk_size : int, default 300
+        largest chunk size to grow to, the api's limit
+    max_concurrency : int, default 8
+        most requests to allow in flight, the callers' thread count also
+        caps this
+    target_latency : float, default 2.0
+        seconds a request can take before it counts as slow
+    throttle_pause : float, default 1.0
+        seconds to pause after throttling without a Retry-After header
+    """
+
+    def __init__(
+        self, chunk_size=MAX_CHUNK, min_chunk_size=25, max_chunk_size=300,
+        max_concurrency=8, target_latency=2.0, throttle_pause=1.0
+    ):
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.throttle_pause = throttle_pause
+        self.concurrency = 1
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.throttled = 0
+        self._fast = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Wait for room to make a request, and hold it while it runs"""
+        with self._cond:
+            while True:
+                pause = self.resume_at - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self.in_flight >= self.concurrency:
+                    self._cond.wait()
+                else:
+                    break
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def record(self, response, latency):
+        """Adjust the limits from how a request went
+
+        Parameters
+        ----------
+        response : requests.Response
+            the response the request got
+        latency : float
+            seconds the request took
+        """
+        retries = getattr(response.raw, 'retries', None)
+        statuses = [h.status for h in getattr(retries, 'history', ())]
+        statuses.append(response.status_code)
+        with self._cond:
+            if any(status in THROTTLE_STATUSES for status in statuses):
+                self.throttled += 1
+                self._fast = 0
+                self.concurrency = max(1, self.concurrency // 2)
+                self.chunk_size = max(
+                    self.min_chunk_size, self.chunk_size // 2
+                    )
+                pause = parse_retry_after(
+                    response.headers.get('Retry-After')
+                    )
+                if pause is None:
+                    pause = self.throttle_pause
+                self.resume_at = max(self.resume_at, time.monotonic() + pause)
+            elif latency > self.target_latency:
+                self._fast = 0
+                self.concurrency = max(1, self.concurrency - 1)
+                self.chunk_size = max(
+                    self.min_chunk_size, int(self.chunk_size * 0.75)
+                    )
+            else:
+                self._fast += 1
+                # Grow once per round of fast responses at this concurrency
+                if self._fast >= self.concurrency:
+                    self._fast = 0
+                    self.concurrency = min(
+                        self.max_concurrency, self.concurrency + 1
+                        )
+                    self.chunk_size = min(
+                        self.max_chunk_size, self.chunk_size + 25
+                        )
+            self._cond.notify_all()
+
+
+def set_metrics_sink(sink):
+    """Choose where stage measurements are sent
+
+    Parameters
+    ----------
+    sink : callable or None
+        called with a dict for every finished stage, e.g. a MetricsCollector,
+        the result of logging_sink or your own callback. None turns
+        measurement off
+    """
+    global METRICS_SINK
+    METRICS_SINK = sink
+
+
+def logging_sink(logger=None, level=logging.INFO):
+    """A metrics sink that writes each stage to a logger
+
+    Parameters
+    ----------
+    logger : logging.Logger, optional, default None
+        logger to write to, defaults to the 'stats_can' logger
+    level : int, default logging.INFO
+        level to log at
+
+    Returns
+    -------
+    callable
+        sink to pass to set_metrics_sink
+    """
+    logger = logger or logging.getLogger('stats_can')
+
+    def log_stage(record):
+        """Log one stage"""
+        logger.log(level, '%s', record)
+    return log_stage
+
+
+class MetricsCollector:
+    """A metrics sink that keeps every stage in memory
+
+    Attributes
+    ----------
+    records : list of dicts
+        one for each finished stage, in the order they finished
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self):
+        """Total duration, bytes, rows and retries by stage
+
+        Returns
+        -------
+        dict
+            stage name mapped to a dict of totals and a count of calls
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {
+                'calls': 0, 'seconds': 0.0, 'bytes': 0, 'rows': 0,
+                'retries': 0
+                })
+            total['calls'] += 1
+            for key in ['seconds', 'bytes', 'rows', 'retries']:
+                total[key] += record[key]
+        return totals
+
+
+class StageMetrics(dict):
+    """Measurements for one stage, see stage"""
+
+    def add(self, **counts):
+        """Add to the bytes, rows or retries counted for the stage"""
+        for key, value in counts.items():
+            self[key] = self.get(key, 0) + value
+
+
+@contextmanager
+def stage(name, **fields):
+    """Measure a stage of the pipeline and send it to METRICS_SINK
+
+    The block gets a StageMetrics to count bytes, rows and retries on. When
+    it finishes the sink is called with the stage name, any extra fields,
+    the counts, seconds taken, process peak resident memory so far in MB
+    and the error if the block raised. Nothing is measured with no sink.
+
+    Parameters
+    ----------
+    name : str
+        name of the stage, e.g. 'download' or 'csv_parse'
+    **fields
+        extra identifying fields to include, e.g. table
+
+    Yields
+    ------
+    metrics : StageMetrics
+    """
+    metrics = StageMetrics(stage=name, bytes=0, rows=0, retries=0, **fields)
+    if METRICS_SINK is None:
+        yield metrics
+        return
+    start = time.perf_counter()
+    try:
+        yield metrics
+    except BaseException as e:
+        metrics['error'] = repr(e)
+        raise
+    finally:
+        metrics['seconds'] = time.perf_counter() - start
+        if resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == 'darwin':  # bytes there, kilobytes elsewhere
+                peak /= 1024
+            metrics['peak_rss_mb'] = peak / 1024
+        METRICS_SINK(dict(metrics))
+
+
+@contextmanager
+def store_lock(store_file, exclusive=False):
+    """Hold a lock on a local store for reading or writing
+
+    Any number of readers can hold the shared lock at once, a writer waits
+    for them to finish and keeps everyone else out while it holds the
+    exclusive lock. The lock is an flock on store_file + '.lock', so it
+    works across threads, notebook kernels and other processes on the same
+    machine. Locks can't be nested, release a shared lock before taking the
+    exclusive one. On systems without fcntl this does nothing.
+
+    Parameters
+    ----------
+    store_file : str or path
+        the store to lock
+    exclusive : bool, default False
+        take the writer's lock rather than a reader's
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(str(store_file) + '.lock', 'a') as lock_file:
+        fcntl.flock(
+            lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            )
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class DataFrameCache:
+    """Keep recently used DataFrames in memory up to a size limit
+
+    Entries are stored under a key with a version, a lookup with a
+    different version is a miss and drops the stale entry, so bumping the
+    version is all it takes to invalidate. When the cache is over its limit
+    the least recently used entries are evicted. DataFrames are copied in
+    and out, so callers can change what they get back.
+
+    Parameters
+    ----------
+    max_bytes : int
+        most memory the cached frames can take, 0 to cache nothing
+
+    Attributes
+    ----------
+    hits, misses, evictions : int
+        lookups answered, lookups not answered and entries evicted
+    nbytes : int
+        memory taken by the cached frames
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Return a copy of the frame cached for key at version, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != version:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1].copy()
+
+    def put(self, key, version, df):
+        """Cache a copy of df for key at version, evicting if needed"""
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        df = df.copy()
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (version, df, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        self.nbytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        """Empty the cache, the statistics are kept"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Hits, misses, evictions, entries, bytes used and the limit
+
+        Returns
+        -------
+        dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes
+                }
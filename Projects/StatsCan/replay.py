@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Record StatsCan api traffic to disk and replay it without the network
+
+Both work as transport adapters on a requests session, so install one with
+scwds.set_session and every call in scwds and sc goes through it.
+
+Record once against the real api:
+    set_session(recording_session('recordings'))
+    download_tables(['14100287'])
+
+Then replay offline, optionally with simulated network conditions:
+    set_session(replay_session('recordings', latency=0.05))
+
+Each response is saved as a json file with its status and headers, plus the
+body in a separate file so large table zips can be streamed back and served
+in byte ranges. Requests are matched on method, url and body.
+"""
+import os
+import io
+import json
+import time
+import hashlib
+import threading
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+try:
+    from .scwds import make_session
+except ImportError:  # run with %run -i after scwds.py
+    pass
+
+
+def request_key(request):
+    """Key a recording by the parts of a request that identify it
+
+    Parameters
+    ----------
+    request: requests.PreparedRequest
+        the request to key
+
+    Returns
+    -------
+    str
+        hex digest of the method, url and body
+    """
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    digest = hashlib.sha1()
+    digest.update(request.method.encode('utf-8') + b' ')
+    digest.update(request.url.encode('utf-8') + b' ')
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class ThrottledReader(io.RawIOBase):
+    """File wrapper that limits how fast it can be read
+
+    Parameters
+    ----------
+    handle: file object
+        open binary file to read from
+    bandwidth: float or None
+        bytes per second to allow, None for no limit
+    """
+
+    def __init__(self, handle, bandwidth=None):
+        super().__init__()
+        self.handle = handle
+        self.bandwidth = bandwidth
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        if self.bandwidth and data:
+            time.sleep(len(data) / self.bandwidth)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.handle.close()
+        super().close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """Serve requests from responses saved by RecordingAdapter
+
+    Parameters
+    ----------
+    directory: str or path
+        where the recordings are kept
+    latency: float, default 0
+        seconds to wait before answering each request
+    bandwidth: float, optional, default None
+        bytes per second to stream bodies at, None for as fast as possible
+
+    Attributes
+    ----------
+    requests_served: int
+        number of requests answered
+    bytes_served: int
+        number of body bytes handed out
+    """
+
+    def __init__(self, directory, latency=0, bandwidth=None):
+        super().__init__()
+        self.directory = directory
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests_served = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+
+    def send(self, request, stream=False, **kwargs):
+        """Answer request from its recording"""
+        key = request_key(request)
+        meta_file = os.path.join(self.directory, key + '.json')
+        body_file = os.path.join(self.directory, key + '.body')
+        if not os.path.isfile(meta_file):
+            raise requests.exceptions.ConnectionError(
+                'No recording for {} {}'.format(request.method, request.url),
+                request=request
+                )
+        if self.latency:
+            time.sleep(self.latency)
+        with open(meta_file) as f_name:
+            meta = json.load(f_name)
+        size = os.path.getsize(body_file)
+        handle = open(body_file, 'rb')
+        status = meta['status_code']
+        headers = CaseInsensitiveDict(meta['headers'])
+        byte_range = request.headers.get('Range')
+        # A range is only served if the content is what the caller has part of
+        if_range = request.headers.get('If-Range')
+        if if_range is not None and if_range not in (
+            headers.get('ETag'), headers.get('Last-Modified')
+        ):
+            byte_range = None
+        if byte_range and status == 200:
+            start = int(byte_range.split('=')[1].split('-')[0])
+            if start >= size:
+                status = 416
+                handle.close()
+                handle = io.BytesIO(b'')
+                size = 0
+            else:
+                status = 206
+                handle.seek(start)
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                    start, size - 1, size
+                    )
+                size -= start
+        headers['Content-Length'] = str(size)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = headers
+        response.reason = meta.get('reason')
+        response.encoding = requests.utils.get_encoding_from_headers(headers)
+        response.raw = ThrottledReader(handle, self.bandwidth)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        with self._lock:
+            self.requests_served += 1
+            self.bytes_served += size
+        return response
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Send requests to the real api and save every response to disk
+
+    Bodies are streamed to disk as they arrive and the response handed back
+    is read from the saved copy, so recording a large zip doesn't hold it in
+    memory.
+
+    Parameters
+    ----------
+    directory: str or path
+        where to save the recordings, created if needed
+    **kwargs
+        passed on to requests.adapters.HTTPAdapter
+    """
+
+    def __init__(self, directory, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.replay = ReplayAdapter(directory)
+
+    def send(self, request, stream=False, **kwargs):
+        """Send request, save the response, and replay it to the caller"""
+        key = request_key(request)
+        body_file = os.path.join(self.directory, key + '.body')
+        meta_file = os.path.join(self.directory, key + '.json')
+        if os.path.isfile(meta_file):
+            return self.replay.send(request, stream=stream, **kwargs)
+        # Record whole bodies, ranges are served from them on replay
+        upstream = request.copy()
+        upstream.headers.pop('Range', None)
+        upstream.headers.pop('If-Range', None)
+        response = super().send(upstream, stream=True, **kwargs)
+        with open(body_file + '.part', 'wb') as handle:
+            for chunk in response.raw.stream(1024 * 1024, decode_content=True):
+                handle.write(chunk)
+        response.close()
+        os.replace(body_file + '.part', body_file)
+        # The saved body is already decoded
+        headers = {
+            k: v for k, v in response.headers.items()
+            if k.lower() not in ('content-encoding', 'content-length',
+                                 'transfer-encoding')
+            }
+        meta = {
+            'method': request.method,
+            'url': request.url,
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': headers
+            }
+        with open(meta_file, 'w') as outfile:
+            json.dump(meta, outfile)
+        return self.replay.send(request, stream=stream, **kwargs)
+
+
+def replay_session(directory, latency=0, bandwidth=None):
+    """A session that answers every request from recordings
+
+    Parameters
+    ----------
+    directory: str or path
+        where the recordings are kept
+    latency: float, default 0
+        seconds to wait before answering each request
+    bandwidth: float, optional, default None
+        bytes per second to stream bodies at, None for as fast as possible
+
+    Returns
+    -------
+    session: requests.Session
+        session with a ReplayAdapter mounted for http and https
+    """
+    adapter = ReplayAdapter(directory, latency=latency, bandwidth=bandwidth)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def recording_session(directory, pool_size=10):
+    """A session that records every request it makes against the real api
+
+    Parameters
+    ----------
+    directory: str or path
+        where to save the recordings
+    pool_size: int, default 10
+        number of connections to keep open per host
+
+    Returns
+    -------
+    session: requests.Session
+        session like make_session's with a RecordingAdapter mounted
+    """
+    session = make_session(pool_size=pool_size)
+    retry = session.get_adapter('https://').max_retries
+    adapter = RecordingAdapter(
+        directory,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry
+        )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
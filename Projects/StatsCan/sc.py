@@ -4,33 +4,199 @@
 TODO
 ----
 Function to delete tables
-
-Extend getChangedCubeList with a function that returns all tables updated
-within a date range
 """
 import os
+import io
+import datetime as dt
+import csv
 import json
+import shutil
+import hashlib
+import sqlite3
 import zipfile
-import h5py
-import pandas as pd
-import numpy as np
-import requests
-# from stats_can.scwds import get_series_info_from_vector
-# from stats_can.scwds import get_data_from_vectors_and_latest_n_periods
-# from stats_can.scwds import get_bulk_vector_data_by_range
-# from stats_can.scwds import get_cube_metadata
-# from stats_can.scwds import get_full_table_download
-# from stats_can.helpers import parse_tables
-# from stats_can.helpers import parse_vectors
-
-
-def get_tables_for_vectors(vectors):
+from contextlib import closing, contextmanager
+from concurrent.futures import (
+    ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+)
+# Imported as part of the package these come from its other modules, run
+# with %run -i after helpers.py and scwds.py they're already defined
+try:
+    from .scwds import get_session
+    from .scwds import get_series_info_from_vector
+    from .scwds import get_data_from_vectors_and_latest_n_periods
+    from .scwds import get_bulk_vector_data_by_range
+    from .scwds import get_cube_metadata
+    from .scwds import get_changed_cube_list
+    from .scwds import get_changed_series_list
+    from .scwds import get_changed_series_data_from_vector
+    from .scwds import get_full_table_download
+    from .helpers import parse_tables
+    from .helpers import parse_vectors
+    from .helpers import stage
+    from .helpers import store_lock
+    from .helpers import DataFrameCache
+    from .helpers import LazyModule
+except ImportError:
+    pass
+try:
+    from tqdm import tnrange
+except ImportError:
+    def tnrange(*args, desc=None):
+        """range without the progress bar when tqdm isn't installed"""
+        return range(*args)
+
+# Heavy dependencies are imported the first time a function uses them, so
+# importing the package stays fast
+h5py = LazyModule('h5py')
+tb = LazyModule('tables')
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+requests = LazyModule('requests')
+# Only needed for parquet stores
+pq = LazyModule('pyarrow.parquet')
+
+# Bytes read per chunk when streaming table downloads to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Shared, content-addressed cache of downloaded zips, see download_cache_add.
+# Point STATS_CAN_CACHE at a shared directory to share downloads between
+# users, set to None to turn the cache off
+DOWNLOAD_CACHE_DIR = os.environ.get(
+    'STATS_CAN_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'stats_can')
+    )
+# Bytes the download cache may hold, the least recently used zips are pruned
+# past this, see download_cache_prune. None for no limit
+DOWNLOAD_CACHE_MAX_BYTES = int(
+    os.environ.get('STATS_CAN_CACHE_MAX_BYTES', 10 * 1024 ** 3)
+    )
+# Check zips against the hash recorded when they were downloaded before
+# parsing them
+VERIFY_DOWNLOADS = True
+# Rows per chunk when streaming a zipped table
+ZIP_READ_CHUNK_ROWS = 500000
+# Local cache of cube metadata, see cached_cube_metadata
+METADATA_CACHE_FILE = 'stats_can_metadata.json'
+METADATA_CACHE_MAX_DAYS = 30
+# Calls this soon after the last sync reuse its check of the change list
+METADATA_CACHE_SYNC_SECONDS = 60
+# StatsCan release times are Eastern. Fetch times are kept in Eastern
+# Standard Time, which is never ahead of Eastern time, so an entry is never
+# taken to be newer than it is
+STATSCAN_UTC_OFFSET = dt.timedelta(hours=-5)
+# Local index of which table each vector belongs to
+VECTOR_INDEX_FILE = 'stats_can_vectors.sqlite'
+# Columns stored as queryable data columns in h5 tables
+H5_DATA_COLUMNS = ['REF_DATE', 'VECTOR', 'GEO']
+# Dataset in an h5 store that catalogs the tables in it, see h5_catalog
+H5_CATALOG_KEY = 'catalog'
+# Whole tables read from local storage are kept in memory here, set its
+# max_bytes to 0 to turn it off, see TABLE_CACHE.stats() for hit rates
+TABLE_CACHE = DataFrameCache(max_bytes=512 * 1024 * 1024)
+# Compression and rows per HDF5 chunk for h5 stores that haven't been given
+# settings of their own, see set_h5_store_settings
+H5_COMPLIB = 'zlib'
+H5_COMPLEVEL = 1
+H5_CHUNKSHAPE = None
+# Dataset in an h5 store holding its compression settings
+H5_SETTINGS_KEY = 'settings'
+# Compact an h5 store after deletes and updates once at least this share of
+# the file is dead space, None to only compact when asked, see compact_h5
+H5_COMPACT_DEAD_RATIO = 0.5
+# Rows per row group in parquet stores
+PARQUET_ROW_GROUP_SIZE = 250000
+# Columns every table has that are stored as categories, dimension columns
+# are added from the table metadata, see categorical_columns
+POSSIBLE_CATS = [
+    'GEO', 'DGUID', 'STATUS', 'SYMBOL', 'TERMINATED', 'DECIMALS',
+    'UOM', 'UOM_ID', 'SCALAR_FACTOR', 'SCALAR_ID', 'VECTOR', 'COORDINATE'
+    ]
+# Other text columns become categories if at most this share of their
+# values are distinct
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+
+def vector_index_add(vector_tables, path=None, index_file=VECTOR_INDEX_FILE):
+    """Record which table vectors belong to in the local vector index
+
+    Parameters
+    ----------
+    vector_tables: dict
+        vector numbers (int, or str like 'v123') mapped to their productId
+    path: str or path, default = current working directory
+        where the index file is kept
+    index_file: str, default VECTOR_INDEX_FILE
+        name of the sqlite file holding the index
+    """
+    if not vector_tables:
+        return
+    if path:
+        index_file = os.path.join(path, index_file)
+    rows = list(zip(
+        parse_vectors(list(vector_tables.keys())),
+        parse_tables([str(t) for t in vector_tables.values()])
+        ))
+    with closing(sqlite3.connect(index_file)) as conn:
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS vectors '
+                '(vector INTEGER PRIMARY KEY, product_id TEXT NOT NULL)'
+                )
+            conn.executemany(
+                'INSERT OR REPLACE INTO vectors VALUES (?, ?)', rows
+                )
+
+
+def vector_index_lookup(vectors, path=None, index_file=VECTOR_INDEX_FILE):
+    """Look up the tables for vectors in the local vector index
+
+    Parameters
+    ----------
+    vectors: list of str or str
+        vectors to look up
+    path: str or path, default = current working directory
+        where the index file is kept
+    index_file: str, default VECTOR_INDEX_FILE
+        name of the sqlite file holding the index
+
+    Returns
+    -------
+    found: dict
+        vector numbers mapped to productId for the vectors in the index
+    """
+    if path:
+        index_file = os.path.join(path, index_file)
+    if not os.path.isfile(index_file):
+        return {}
+    vectors = parse_vectors(vectors)
+    found = {}
+    with closing(sqlite3.connect(index_file)) as conn:
+        # Stay under sqlite's limit on query parameters
+        for i in range(0, len(vectors), 500):
+            batch = vectors[i:i + 500]
+            query = (
+                'SELECT vector, product_id FROM vectors WHERE vector IN ('
+                + ','.join('?' * len(batch)) + ')'
+                )
+            try:
+                found.update(conn.execute(query, batch).fetchall())
+            except sqlite3.OperationalError:  # no table yet
+                return {}
+    return found
+
+
+def get_tables_for_vectors(vectors, path=None):
     """ get a list of dicts mapping vectors to tables
 
+    Vectors are looked up in the local vector index first, only the ones it
+    doesn't know about are requested from StatsCan, and the answers are added
+    to the index for next time.
+
     Parameters
     ----------
     vectors : list of str or str
         Vectors to find tables for
+    path: str or path, default = current working directory
+        where the vector index is kept
 
     Returns
     -------
@@ -38,30 +204,38 @@ def get_tables_for_vectors(vectors):
         keys for each vector number return the table, plus a key for
         'all_tables' that has a list of unique tables used by vectors
     """
-    v_json = get_series_info_from_vector(vectors)
-    vectors = [j['vectorId'] for j in v_json]
-    tables_list = {j['vectorId']: str(j['productId']) for j in v_json}
+    vectors = parse_vectors(vectors)
+    known = vector_index_lookup(vectors, path=path)
+    missing = [v for v in vectors if v not in known]
+    if missing:
+        v_json = get_series_info_from_vector(missing)
+        found = {j['vectorId']: str(j['productId']) for j in v_json}
+        vector_index_add(found, path=path)
+        known.update(found)
+    tables_list = {v: known[v] for v in vectors if v in known}
     tables_list['all_tables'] = []
     for vector in vectors:
-        if tables_list[vector] not in tables_list['all_tables']:
-            tables_list['all_tables'].append(tables_list[vector])
+        if vector in known and known[vector] not in tables_list['all_tables']:
+            tables_list['all_tables'].append(known[vector])
     return tables_list
 
 
-def table_subsets_from_vectors(vectors):
+def table_subsets_from_vectors(vectors, path=None):
     """get a list of dicts mapping tables to vectors
 
     Parameters
     ----------
     vectors : list of str or str
         Vectors to find tables for
+    path: str or path, default = current working directory
+        where the vector index is kept
 
     Returns
     -------
     tables_dict: list of dict
         keys for each table used by the vectors, matched to a list of vectors
     """
-    start_tables_dict = get_tables_for_vectors(vectors)
+    start_tables_dict = get_tables_for_vectors(vectors, path=path)
     tables_dict = {t: [] for t in start_tables_dict['all_tables']}
     vecs = list(start_tables_dict.keys())[:-1]  # all but the all_tables key
     for vec in vecs:
@@ -69,9 +243,473 @@ def table_subsets_from_vectors(vectors):
     return tables_dict
 
 
-def download_tables(tables, path=None, csv=True):
+def tables_changed_between(start_date, end_date=None, session=None):
+    """Tables StatsCan released changes to over a range of dates
+
+    Parameters
+    ----------
+    start_date: datetime.date
+        first day to check for changes
+    end_date: datetime.date, default today
+        last day to check for changes, inclusive
+    session: requests.Session, optional, default None
+        session to make the requests with, defaults to the module session
+
+    Returns
+    -------
+    changed: dict
+        productIds of tables that changed on any of the days, mapped to the
+        releaseTime of their latest change
+    """
+    if end_date is None:
+        end_date = dt.date.today()
+    changed = {}
+    day = start_date
+    while day <= end_date:
+        for cube in get_changed_cube_list(day, session=session):
+            table = parse_tables(str(cube['productId']))[0]
+            release = cube.get('releaseTime') or ''
+            changed[table] = max(release, changed.get(table, ''))
+        day += dt.timedelta(days=1)
+    return changed
+
+
+def cached_cube_metadata(
+    tables, path=None, cache_file=METADATA_CACHE_FILE, session=None
+):
+    """get_cube_metadata backed by a cache on disk
+
+    Metadata is kept in a json file keyed by productId, along with when
+    each entry was fetched. Each call first asks StatsCan which tables
+    changed since the last sync and drops the entries fetched before the
+    change was released, then only requests metadata for tables missing from
+    the cache. Calls within METADATA_CACHE_SYNC_SECONDS of the last sync,
+    like the several made by one update, skip asking again. If the last sync
+    is more than METADATA_CACHE_MAX_DAYS old the whole cache is thrown out
+    instead of checking day by day.
+
+    Parameters
+    ----------
+    tables: str or list of str
+        IDs of tables to get metadata for
+    path: str or path, default = current working directory
+        where to keep the cache file
+    cache_file: str, default METADATA_CACHE_FILE
+        name of the cache file
+    session: requests.Session, optional, default None
+        session to make the requests with, defaults to the module session
+
+    Returns
+    -------
+    list of dicts
+        one for each table with its metadata, in the same order as tables
+    """
+    tables = parse_tables(tables)
+    if path:
+        cache_file = os.path.join(path, cache_file)
+    cache = {'last_sync': None, 'tables': {}}
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as f_name:
+                cache = json.load(f_name)
+        except ValueError as e:
+            print('failed to read metadata cache ' + cache_file)
+            print(e)
+    fetched = cache.setdefault('fetched', {})
+    now = dt.datetime.now()
+    if cache['last_sync']:
+        last_sync = dt.datetime.fromisoformat(cache['last_sync'])
+        if (now - last_sync).days > METADATA_CACHE_MAX_DAYS:
+            cache['tables'] = {}
+            fetched.clear()
+        elif (now - last_sync).total_seconds() > METADATA_CACHE_SYNC_SECONDS:
+            # Include the last sync day, releases may have come after it
+            changed = tables_changed_between(
+                last_sync.date(), now.date(), session
+                )
+            for table, release in changed.items():
+                if fetched.get(table, '')[:16] <= release[:16] or not release:
+                    cache['tables'].pop(table, None)
+        else:
+            now = last_sync
+    missing = [t for t in dict.fromkeys(tables) if t not in cache['tables']]
+    if missing:
+        fetch_time = dt.datetime.now(dt.timezone(STATSCAN_UTC_OFFSET))
+        with stage('metadata', tables=len(missing)) as metrics:
+            for meta in get_cube_metadata(missing, session=session):
+                cache['tables'][meta['productId']] = meta
+                fetched[meta['productId']] = fetch_time.strftime(
+                    '%Y-%m-%dT%H:%M'
+                    )
+            metrics.add(rows=len(missing))
+    cache['last_sync'] = now.isoformat(timespec='seconds')
+    # A part file of our own, other processes may be writing the cache too
+    part = '{}.{}.part'.format(cache_file, os.getpid())
+    with open(part, 'w') as outfile:
+        json.dump(cache, outfile)
+    os.replace(part, cache_file)
+    return [cache['tables'][t] for t in tables]
+
+
+def download_validator(response):
+    """The ETag or Last-Modified date that identifies a response's content
+
+    Weak ETags can't be used to resume a download, so Last-Modified is used
+    instead. None if the response has neither.
+    """
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def download_file(url, file_name, session=None, retries=5):
+    """Stream url to file_name, resuming a partial download if there is one
+
+    Bytes go to file_name + '.part' which is only renamed to file_name once
+    the download is complete, so an interrupted download never leaves a
+    truncated file behind. If a '.part' file already exists, or the
+    connection drops part way through, the download picks up where it left
+    off with an HTTP Range request. The range is sent with If-Range and the
+    ETag or Last-Modified date of the response the '.part' file came from,
+    kept in file_name + '.part.validator', so the server sends the whole
+    file again instead of the rest of a file that has since changed. A
+    '.part' file without one is started over.
+
+    Parameters
+    ----------
+    url: str
+        where to download from
+    file_name: str or path
+        where to save the download
+    session: requests.Session, optional, default None
+        session to download with, defaults to the scwds module session
+    retries: int, default 5
+        how many times to resume after the connection drops
+
+    Returns
+    -------
+    file_name: str or path
+        where the download was saved
+
+    Raises
+    ------
+    requests.exceptions.RetryError
+        if every attempt had to start over because the server answered
+        with a range other than the one asked for
+    """
+    session = get_session(session)
+    part_file = str(file_name) + '.part'
+    validator_file = part_file + '.validator'
+    with stage('download', file=os.path.basename(file_name)) as metrics:
+        for attempt in range(retries + 1):
+            have = 0
+            validator = None
+            if os.path.isfile(part_file):
+                have = os.path.getsize(part_file)
+            if have and os.path.isfile(validator_file):
+                with open(validator_file) as f_name:
+                    validator = f_name.read()
+            # Thanks http://evanhahn.com/python-requests-library-useragent/
+            # Zips don't gain from gzip and byte ranges need the raw encoding
+            headers = {'user-agent': None, 'Accept-Encoding': 'identity'}
+            if have and validator:
+                headers['Range'] = 'bytes={}-'.format(have)
+                headers['If-Range'] = validator
+            try:
+                response = session.get(url, stream=True, headers=headers)
+                with response:
+                    if response.status_code == 416:
+                        # Range starts past the end, the part file is suspect
+                        os.remove(part_file)
+                        continue
+                    response.raise_for_status()
+                    resumed = (
+                        'Range' in headers
+                        and response.status_code == 206
+                        and response.headers.get(
+                            'Content-Range', ''
+                            ).startswith('bytes {}-'.format(have))
+                        )
+                    if response.status_code == 206 and not resumed:
+                        # Not the range asked for, start over
+                        if os.path.isfile(part_file):
+                            os.remove(part_file)
+                        continue
+                    # A 200 means the file changed or the server ignored the
+                    # range, either way it's the whole file
+                    mode = 'ab' if resumed else 'wb'
+                    if not resumed:
+                        new_validator = download_validator(response)
+                        if new_validator:
+                            with open(validator_file, 'w') as outfile:
+                                outfile.write(new_validator)
+                        elif os.path.isfile(validator_file):
+                            os.remove(validator_file)
+                    expected = response.headers.get('Content-Length')
+                    written = 0
+                    with open(part_file, mode) as handle:
+                        for chunk in response.iter_content(
+                            chunk_size=DOWNLOAD_CHUNK_SIZE
+                        ):
+                            handle.write(chunk)
+                            written += len(chunk)
+                            metrics.add(bytes=len(chunk))
+                if expected is not None and written < int(expected):
+                    raise requests.exceptions.ChunkedEncodingError(
+                        'Connection closed early downloading ' + url
+                        )
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError
+            ):
+                if attempt == retries:
+                    raise
+                metrics.add(retries=1)
+                continue
+            break
+        else:
+            # Every attempt ended by starting over
+            raise requests.exceptions.RetryError(
+                'Gave up downloading {} after {} attempts, the server kept '
+                'answering with the wrong range'.format(url, retries + 1)
+                )
+    os.replace(part_file, file_name)
+    if os.path.isfile(validator_file):
+        os.remove(validator_file)
+    return file_name
+
+
+def file_sha256(file_name):
+    """Hex sha256 digest of a file, read a chunk at a time"""
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_cache_files(key, sha256=None, cache_dir=None):
+    """Where the download cache keeps an entry and its content
+
+    Parameters
+    ----------
+    key: str
+        the download, see download_tables for how tables are keyed
+    sha256: str, optional, default None
+        hash of the content, to locate it in the cache
+    cache_dir: str or path, optional, default None
+        the cache, defaults to DOWNLOAD_CACHE_DIR
+
+    Returns
+    -------
+    index_file: str
+        json file recording the hash and size of key's content
+    object_file: str or None
+        where content with sha256 is stored, None if no hash was given
+    """
+    cache_dir = cache_dir or DOWNLOAD_CACHE_DIR
+    safe_key = ''.join(c if c.isalnum() or c in '-_' else '_' for c in key)
+    index_file = os.path.join(cache_dir, 'index', safe_key + '.json')
+    object_file = None
+    if sha256:
+        object_file = os.path.join(
+            cache_dir, 'objects', sha256[:2], sha256 + '.zip'
+            )
+    return index_file, object_file
+
+
+def link_or_copy(source, file_name):
+    """Hard link source to file_name, copying if they can't share a link
+
+    The link or copy is made under a temporary name and renamed over
+    file_name, so whatever was at file_name stays there if it fails.
+    """
+    part = '{}.{}.part'.format(file_name, os.getpid())
+    if os.path.isfile(part):
+        os.remove(part)
+    try:
+        try:
+            os.link(source, part)
+        except OSError:  # different file systems, or no hard links
+            shutil.copyfile(source, part)
+        os.replace(part, file_name)
+    finally:
+        if os.path.isfile(part):
+            os.remove(part)
+
+
+def download_cache_get(key, file_name, cache_dir=None):
+    """Put a cached download at file_name if the cache has a good copy
+
+    The cached content is checked against its recorded size and hash
+    first, a copy that doesn't match is thrown out.
+
+    Parameters
+    ----------
+    key: str
+        the download to look for
+    file_name: str or path
+        where to put it
+    cache_dir: str or path, optional, default None
+        the cache, defaults to DOWNLOAD_CACHE_DIR
+
+    Returns
+    -------
+    sha256: str or None
+        hash of the content put at file_name, None if it isn't cached
+    """
+    index_file, _ = download_cache_files(key, cache_dir=cache_dir)
+    if not os.path.isfile(index_file):
+        return None
+    with open(index_file) as f_name:
+        entry = json.load(f_name)
+    _, object_file = download_cache_files(key, entry['sha256'], cache_dir)
+    if not os.path.isfile(object_file):
+        return None
+    if (
+        os.path.getsize(object_file) != entry['size']
+        or file_sha256(object_file) != entry['sha256']
+    ):
+        os.remove(object_file)
+        return None
+    with stage('download_cache_hit', file=os.path.basename(file_name)) as m:
+        link_or_copy(object_file, file_name)
+        m.add(bytes=entry['size'])
+    # The index entry's modified time is when it was last used, for pruning.
+    # Entries another user made may not be ours to touch
+    try:
+        os.utime(index_file)
+    except OSError:
+        pass
+    return entry['sha256']
+
+
+def download_cache_add(key, file_name, cache_dir=None):
+    """Add a finished download to the cache
+
+    Content is stored once under its sha256 however many keys, paths or
+    users it's downloaded for, and file_name becomes a link to the cached
+    copy where the file system allows it.
+
+    Parameters
+    ----------
+    key: str
+        the download, see download_tables for how tables are keyed
+    file_name: str or path
+        the downloaded file
+    cache_dir: str or path, optional, default None
+        the cache, defaults to DOWNLOAD_CACHE_DIR
+
+    Returns
+    -------
+    sha256: str
+        hash of the file
+    """
+    sha256 = file_sha256(file_name)
+    size = os.path.getsize(file_name)
+    index_file, object_file = download_cache_files(key, sha256, cache_dir)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    os.makedirs(os.path.dirname(object_file), exist_ok=True)
+    # The entry goes in first, so a prune never sees the content as unused
+    entry = {'key': key, 'sha256': sha256, 'size': size}
+    part = '{}.{}.part'.format(index_file, os.getpid())
+    with open(part, 'w') as outfile:
+        json.dump(entry, outfile)
+    os.replace(part, index_file)
+    if not (
+        os.path.isfile(object_file)
+        and os.path.getsize(object_file) == size
+    ):
+        link_or_copy(file_name, object_file)
+    link_or_copy(object_file, file_name)
+    return sha256
+
+
+def download_cache_prune(max_bytes=None, cache_dir=None):
+    """Remove the least recently used downloads until the cache fits
+
+    A download was last used when its index entry was last written or read
+    from, content no entry points to when it was itself last written.
+    Entries left pointing at removed content are removed with it. Files
+    already removed by another prune are skipped.
+
+    Parameters
+    ----------
+    max_bytes: int, optional, default None
+        bytes the cache may hold, defaults to DOWNLOAD_CACHE_MAX_BYTES
+    cache_dir: str or path, optional, default None
+        the cache, defaults to DOWNLOAD_CACHE_DIR
+
+    Returns
+    -------
+    removed_bytes: int
+        size of the content removed
+    """
+    cache_dir = cache_dir or DOWNLOAD_CACHE_DIR
+    if max_bytes is None:
+        max_bytes = DOWNLOAD_CACHE_MAX_BYTES
+    if max_bytes is None:
+        return 0
+    index_dir = os.path.join(cache_dir, 'index')
+    object_dir = os.path.join(cache_dir, 'objects')
+    last_used = {}
+    entries = {}
+    for entry_name in os.listdir(index_dir):
+        index_file = os.path.join(index_dir, entry_name)
+        try:
+            with open(index_file) as f_name:
+                sha256 = json.load(f_name)['sha256']
+            used = os.path.getmtime(index_file)
+        except (OSError, ValueError, KeyError):
+            continue
+        entries.setdefault(sha256, []).append(index_file)
+        last_used[sha256] = max(used, last_used.get(sha256, used))
+    objects = []
+    for prefix in os.listdir(object_dir):
+        for object_name in os.listdir(os.path.join(object_dir, prefix)):
+            if not object_name.endswith('.zip'):
+                continue
+            object_file = os.path.join(object_dir, prefix, object_name)
+            sha256 = object_name[:-len('.zip')]
+            try:
+                stat = os.stat(object_file)
+            except FileNotFoundError:
+                continue
+            objects.append(
+                (last_used.get(sha256, stat.st_mtime), sha256, object_file,
+                 stat.st_size)
+                )
+    total_bytes = sum(size for *_, size in objects)
+    removed_bytes = 0
+    for _, sha256, object_file, size in sorted(objects):
+        if total_bytes - removed_bytes <= max_bytes:
+            break
+        for cache_file in entries.get(sha256, []) + [object_file]:
+            try:
+                os.remove(cache_file)
+            except FileNotFoundError:
+                pass
+        removed_bytes += size
+    return removed_bytes
+
+
+def download_tables(
+    tables, path=None, csv=True, session=None, max_in_flight=1
+):
     """Download a json file and zip of data for a list of tables to path
 
+    Zips are streamed through download_file so partial downloads resume and
+    are only renamed into place once complete. The json for a table is
+    written after its zip, so a json file always means a complete zip, and
+    records the zip's sha256 as zipSha256.
+
+    Zips are kept in the download cache in DOWNLOAD_CACHE_DIR keyed on the
+    table, format and the release it's from, so a table already downloaded
+    for this release, to any path, is linked from there instead. The cache
+    is kept under DOWNLOAD_CACHE_MAX_BYTES by dropping the least recently
+    used zips.
+
     Parameters
     ----------
     tables: list of str
@@ -80,18 +718,23 @@ def download_tables(tables, path=None, csv=True):
         Where to download the table and json
     csv: boolean, default True
         download in CSV format, if not download SDMX
+    session: requests.Session, optional, default None
+        session to download with, defaults to the scwds module session
+    max_in_flight: int, default 1
+        number of tables to download at the same time
 
     Returns
     -------
     downloaded: list
         list of tables that were downloaded
     """
-    metas = get_cube_metadata(tables)
-    size=len(metas)
-    for i in tnrange(size, desc='Downloading Dataset'):# For each soup
-        sleep(0.001)
-        product_id = metas[i]['productId']
-        zip_url = get_full_table_download(product_id, csv=csv)
+    session = get_session(session)
+    metas = cached_cube_metadata(tables, path=path, session=session)
+    size = len(metas)
+
+    def download_one(meta):
+        """Download the zip then the json for one table"""
+        product_id = meta['productId']
         if csv:
             zip_file = product_id + '-eng.zip'
         else:
@@ -100,20 +743,40 @@ def download_tables(tables, path=None, csv=True):
         if path:
             zip_file = os.path.join(path, zip_file)
             json_file = os.path.join(path, json_file)
-        # Thanks http://evanhahn.com/python-requests-library-useragent/
-        response = requests.get(
-            zip_url,
-            stream=True,
-            headers={'user-agent': None}
+        key = '{}-{}-{}'.format(
+            product_id, 'csv' if csv else 'sdmx', meta.get('releaseTime', '')
             )
-        # Thanks https://bit.ly/2sPYPYw
-        with open(json_file, 'w') as outfile:
-            json.dump(metas[i], outfile)
-        with open(zip_file, 'wb') as handle:
-            for chunk in response.iter_content(chunk_size=512):
-                if chunk:  # filter out keep-alive new chunks
-                    handle.write(chunk)
-    downloaded = [metas[i]['productId'] for meta in metas]
+        sha256 = None
+        # The cache only saves work, if it can't be used download as usual
+        if DOWNLOAD_CACHE_DIR:
+            try:
+                sha256 = download_cache_get(key, zip_file)
+            except OSError:
+                sha256 = None
+        if sha256 is None:
+            zip_url = get_full_table_download(
+                product_id, csv=csv, session=session
+                )
+            download_file(zip_url, zip_file, session=session)
+            try:
+                if DOWNLOAD_CACHE_DIR:
+                    sha256 = download_cache_add(key, zip_file)
+                    download_cache_prune()
+            except OSError:
+                pass
+            sha256 = sha256 or file_sha256(zip_file)
+        with open(json_file + '.part', 'w') as outfile:
+            json.dump(dict(meta, zipSha256=sha256), outfile)
+        os.replace(json_file + '.part', json_file)
+        return product_id
+
+    workers = max(1, min(max_in_flight, size))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download_one, meta) for meta in metas]
+        done = as_completed(futures)
+        for i in tnrange(size, desc='Downloading Dataset'):
+            next(done).result()
+    downloaded = [meta['productId'] for meta in metas]
     return downloaded
 
 
@@ -142,7 +805,7 @@ def zip_update_tables(path=None, csv=True):
     """
     local_jsons = list_zipped_tables(path=path)
     tables = [j['productId'] for j in local_jsons]
-    remote_jsons = get_cube_metadata(tables)
+    remote_jsons = cached_cube_metadata(tables, path=path)
     update_table_list = []
     for local, remote in zip(local_jsons, remote_jsons):
         if local['cubeEndDate'] != remote['cubeEndDate']:
@@ -151,24 +814,86 @@ def zip_update_tables(path=None, csv=True):
     return update_table_list
 
 
-def zip_table_to_dataframe(table, path=None):
-    """Reads a StatsCan table into a pandas DataFrame
+def parse_ref_date(ref_date):
+    """Parse a REF_DATE column to datetimes
+
+    Parameters
+    ----------
+    ref_date: pd.Series
+        REF_DATE strings, usually formatted as year-month
+
+    Returns
+    -------
+    pd.Series
+        REF_DATE as datetime64
+    """
+    try:
+        return pd.to_datetime(ref_date, format='%Y-%m')
+    except (TypeError, ValueError):
+        return pd.to_datetime(ref_date)
+
+
+def categorical_columns(sample, metadata=None):
+    """Pick which columns of a table to store as categories
+
+    The standard StatsCan columns in POSSIBLE_CATS and any dimension named in
+    the table metadata are always categories. Other text columns are if at
+    most CATEGORY_MAX_UNIQUE_RATIO of their values in sample are distinct.
+
+    Parameters
+    ----------
+    sample: pandas.DataFrame
+        rows of the table, read as text
+    metadata: dict, optional, default None
+        cube metadata for the table
+
+    Returns
+    -------
+    cats: list of str
+        columns to store as categories
+    """
+    cats = set(POSSIBLE_CATS)
+    if metadata:
+        cats.update(
+            d['dimensionNameEn'] for d in metadata.get('dimension', [])
+            )
+    for col in sample.columns:
+        if col in cats or col in ('REF_DATE', 'VALUE'):
+            continue
+        if pd.api.types.is_string_dtype(sample[col]) and len(sample):
+            ratio = sample[col].nunique() / len(sample)
+            if ratio <= CATEGORY_MAX_UNIQUE_RATIO:
+                cats.add(col)
+    return [col for col in sample.columns if col in cats]
+
+
+def iter_zip_table(table, path=None, chunksize=ZIP_READ_CHUNK_ROWS):
+    """Read a zipped StatsCan table in chunks of rows
+
+    Each chunk has its categorical columns cast and REF_DATE parsed as soon
+    as it is read, so the first rows are available before the rest of the
+    file has been decompressed. Which columns are categorical is settled on
+    the first chunk with categorical_columns, using the table's json
+    metadata if it is in path. Categories are only those seen in the chunk,
+    use zip_table_to_dataframe to get a frame with unified categories.
 
     If a zip file of the table does not exist in path, downloads it
 
     Parameters
     ----------
     table: str
-        the table to load to dataframe from zipped csv
+        the table to read from zipped csv
     path: str, default: current working directory when module is loaded
         where to download the tables or load them
+    chunksize: int, default ZIP_READ_CHUNK_ROWS
+        number of rows in each chunk, None to read the table in one piece
 
-    Returns:
+    Yields
+    ------
     df: pandas.DataFrame
-        the table as a dataframe
+        the next chunk of rows of the table
     """
     # Parse tables returns a list, can only do one table at a time here though
-    print("PARSING DATA AS PANDAS DATAFRAME")
     table = parse_tables(table)[0]
     table_zip = table + '-eng.zip'
     if path:
@@ -176,34 +901,119 @@ def zip_table_to_dataframe(table, path=None):
     if not os.path.isfile(table_zip):
         download_tables([table], path)
     csv_file = table + '.csv'
+    json_file = table + '.json'
+    if path:
+        json_file = os.path.join(path, json_file)
+    metadata = None
+    if os.path.isfile(json_file):
+        with open(json_file) as f_name:
+            metadata = json.load(f_name)
+    if VERIFY_DOWNLOADS and metadata and metadata.get('zipSha256'):
+        if file_sha256(table_zip) != metadata['zipSha256']:
+            # Truncated or changed since it was downloaded, fetch it again
+            print("Downloading {} again, its zip is damaged".format(table))
+            os.remove(table_zip)
+            os.remove(json_file)
+            download_tables([table], path)
+            with open(json_file) as f_name:
+                metadata = json.load(f_name)
     with zipfile.ZipFile(table_zip) as myzip:
         with myzip.open(csv_file) as myfile:
-            col_names = pd.read_csv(myfile, nrows=0).columns
-        # reopen the file or it misses the first row
-        with myzip.open(csv_file) as myfile:
+            # Read the header off the stream so the member is only opened once
+            text = io.TextIOWrapper(myfile, encoding='utf-8-sig', newline='')
+            col_names = next(csv.reader([text.readline()]))
             types_dict = {'VALUE': float}
             types_dict.update(
                 {col: str for col in col_names if col not in types_dict}
                 )
-            df = pd.read_csv(
-                myfile,
-                dtype=types_dict
+            actual_cats = None
+            reader = pd.read_csv(
+                text,
+                header=None,
+                names=col_names,
+                dtype=types_dict,
+                chunksize=chunksize
                 )
+            if chunksize is None:
+                reader = [reader]
+            reader = iter(reader)
+            while True:
+                # Decompression happens as the csv is parsed
+                with stage('csv_parse', table=table) as metrics:
+                    df = next(reader, None)
+                    if df is not None:
+                        metrics.add(rows=len(df))
+                if df is None:
+                    break
+                with stage('categorical_cast', table=table) as metrics:
+                    if actual_cats is None:
+                        actual_cats = categorical_columns(df, metadata)
+                    df[actual_cats] = df[actual_cats].astype('category')
+                    metrics.add(rows=len(df))
+                with stage('date_parse', table=table) as metrics:
+                    df['REF_DATE'] = parse_ref_date(df['REF_DATE'])
+                    metrics.add(rows=len(df))
+                if 'VECTOR' in df.columns:
+                    vector_index_add(
+                        dict.fromkeys(df['VECTOR'].dropna().unique(), table),
+                        path=path
+                        )
+                yield df
+
+
+def concat_categorical_chunks(chunks):
+    """Concatenate frames, unifying the categories of categorical columns
+
+    pd.concat falls back to object dtype when categorical columns don't
+    share categories, so align them first.
 
-    possible_cats = [
-        'GEO', 'DGUID', 'STATUS', 'SYMBOL', 'TERMINATED', 'DECIMALS',
-        'UOM', 'UOM_ID', 'SCALAR_FACTOR', 'SCALAR_ID', 'VECTOR', 'COORDINATE',
-        'Wages', 'National Occupational Classification for Statistics (NOC-S)',
-        'Supplementary unemployment rates', 'Sex', 'Age group',
-        'Labour force characteristics', 'Statistics', 'Data type',
-        'Job permanency', 'Union coverage', 'Educational attainment'
-        ]
-    actual_cats = [col for col in possible_cats if col in col_names]
-    df[actual_cats] = df[actual_cats].astype('category')
-    try:
-        df['REF_DATE'] = pd.to_datetime(df['REF_DATE'], format='%Y-%m')
-    except TypeError:
-        df['REF_DATE'] = pd.to_datetime(df['REF_DATE'])
+    Parameters
+    ----------
+    chunks: list of pandas.DataFrame
+        frames with the same columns
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        all the chunks in one frame
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    cat_cols = chunks[0].select_dtypes('category').columns
+    for col in cat_cols:
+        categories = pd.api.types.union_categoricals(
+            [chunk[col] for chunk in chunks]
+            ).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def zip_table_to_dataframe(table, path=None, chunksize=None):
+    """Reads a StatsCan table into a pandas DataFrame
+
+    If a zip file of the table does not exist in path, downloads it
+
+    Parameters
+    ----------
+    table: str
+        the table to load to dataframe from zipped csv
+    path: str, default: current working directory when module is loaded
+        where to download the tables or load them
+    chunksize: int, optional, default None
+        if set, stream the csv in chunks of this many rows, encoding each one
+        as it is read. Peak memory stays much closer to the final table size
+        than reading it in one go
+
+    Returns:
+    df: pandas.DataFrame
+        the table as a dataframe
+    """
+    print("PARSING DATA AS PANDAS DATAFRAME")
+    with stage('zip_table', table=parse_tables(table)[0]) as metrics:
+        chunks = list(iter_zip_table(table, path=path, chunksize=chunksize))
+        df = concat_categorical_chunks(chunks)
+        metrics.add(rows=len(df))
     return df
 
 
@@ -240,30 +1050,758 @@ def list_zipped_tables(path=None):
             print(e)
     return tables
 
-        
-def tables_to_h5(tables, h5file='stats_can.h5', path=None):
-    """Take a table and its metadata and put it in an hdf5 file
+        
+def h5_stream_table(store, hkey, table, path=None, chunksize=None):
+    """Stream a zipped table into an open HDFStore a chunk at a time
+
+    Every chunk appended to an h5 table has to agree on categories and
+    string widths, so a first pass over the zip collects the categories of
+    each categorical column and the longest string. The second pass casts
+    each chunk to those categories and appends it. Indexes on the data
+    columns are only built once all the rows are in. Peak memory is bounded
+    by the chunk size rather than the table size, at the cost of reading
+    the zip twice.
+
+    Parameters
+    ----------
+    store: pandas.HDFStore
+        store open for writing
+    hkey: str
+        key to write the table to, replacing anything already there
+    table: str
+        the table to read from its zipped csv
+    path: str or path, default = current working directory
+        where the zipped table is
+    chunksize: int, default ZIP_READ_CHUNK_ROWS
+        rows to read and append at a time
+
+    Returns
+    -------
+    rows: int
+        number of rows written
+    """
+    chunksize = chunksize or ZIP_READ_CHUNK_ROWS
+    categories = {}
+    max_str = 0
+    for df in iter_zip_table(table, path=path, chunksize=chunksize):
+        for col in df.select_dtypes('category').columns:
+            categories.setdefault(col, set()).update(df[col].cat.categories)
+        for col in df.select_dtypes(object).columns:
+            size = df[col].str.len().max()
+            if pd.notna(size):
+                max_str = max(max_str, int(size))
+    dtypes = {
+        col: pd.CategoricalDtype(sorted(cats))
+        for col, cats in categories.items()
+        }
+    if hkey in store:
+        store.remove(hkey)
+    data_columns = None
+    rows = 0
+    for df in iter_zip_table(table, path=path, chunksize=chunksize):
+        df = df.astype(dtypes)
+        if data_columns is None:
+            data_columns = [c for c in H5_DATA_COLUMNS if c in df.columns]
+        df.index = pd.RangeIndex(rows, rows + len(df))
+        with stage('h5_write', table=table) as metrics:
+            store.append(
+                hkey, df, format='table',
+                data_columns=data_columns, index=False,
+                min_itemsize={'values': max_str} if max_str else None
+                )
+            metrics.add(rows=len(df))
+        rows += len(df)
+    with stage('h5_index', table=table):
+        store.create_table_index(
+            hkey, columns=data_columns, optlevel=9, kind='full'
+            )
+    return rows
+
+
+@contextmanager
+def h5_store_lock(h5file):
+    """Hold off other writers and then readers to change an h5 store in place
+
+    Writers take turns on a writer's lock, which also keeps them from
+    changing the store while h5_store_writer rewrites it, and readers are
+    held off by the store's exclusive lock while the change is made.
+
+    Parameters
+    ----------
+    h5file: str or path
+        the h5 file, including its path
+    """
+    with store_lock(h5file + '.writer', exclusive=True):
+        with store_lock(h5file, exclusive=True):
+            yield
+
+
+@contextmanager
+def h5_store_writer(h5file):
+    """Write a new version of an h5 store and swap it in when done
+
+    Other writers wait on the writer's lock for the whole rewrite, readers
+    keep reading the old file meanwhile and are only held up by the rename.
+    If anything fails, or the new file is removed to back out, the store is
+    left as it was. Don't take the store's own store_lock inside, readers
+    hold it.
+
+    Parameters
+    ----------
+    h5file: str or path
+        the h5 file, including its path
+    Yields
+    ------
+    working: str
+        the new file to write, it doesn't exist yet
+    """
+    with store_lock(h5file + '.writer', exclusive=True):
+        working = '{}.{}.writing'.format(h5file, os.getpid())
+        try:
+            yield working
+            if os.path.isfile(working):
+                with store_lock(h5file, exclusive=True):
+                    os.replace(working, h5file)
+        finally:
+            if os.path.isfile(working):
+                os.remove(working)
+
+
+def h5_copy_tables(source, target, keys, filters=None, chunkshape=None):
+    """Copy pandas tables between h5 files, recompressing and rechunking
+
+    Indexes on the tables' data columns are rebuilt in the copy. A table
+    already in target is replaced, but only once its copy is complete.
+
+    Parameters
+    ----------
+    source: str or path
+        h5 file to copy from
+    target: str or path
+        h5 file to copy into, created if it doesn't exist
+    keys: list of str
+        table keys to copy
+    filters: tables.Filters, optional, default None
+        compression for the copies, None keeps each table's own
+    chunkshape: int, optional, default None
+        rows per HDF5 chunk in the copies, None lets PyTables pick
+    """
+    if chunkshape is not None:
+        chunkshape = (chunkshape,)
+    with tb.open_file(source, 'r') as src, tb.open_file(target, 'a') as dst:
+        for key in keys:
+            staged = key + '_staged'
+            if staged in dst.root:
+                dst.remove_node('/' + staged, recursive=True)
+            src.copy_node(
+                '/' + key, newparent=dst.root, newname=staged,
+                recursive=True, filters=filters, chunkshape=chunkshape,
+                propindexes=True
+                )
+            if key in dst.root:
+                dst.remove_node('/' + key, recursive=True)
+            dst.rename_node('/' + staged, key)
+
+
+def tables_to_h5(
+    tables, h5file='stats_can.h5', path=None, chunksize=None, complib=None,
+    complevel=None, chunkshape=None
+):
+    """Take a table and its metadata and put it in an hdf5 file
+
+    Parameters
+    ----------
+    tables: list of str
+        tables to add to the h5file
+    h5file: str, default stats_can.h5
+        name of the h5file to store the tables in
+    path: str or path, default = current working directory
+        path to the h5file
+    chunksize: int, optional, default None
+        if set, stream each table from its zip into the file this many rows
+        at a time (see h5_stream_table) instead of loading it whole first.
+        Use it for tables too big to hold in memory
+    complib: str, optional, default None
+        compression library, e.g. zlib, blosc:lz4 or blosc:zstd. Defaults to
+        the store's setting, see set_h5_store_settings
+    complevel: int, optional, default None
+        compression level, 0 for none. Defaults to the store's setting
+    chunkshape: int, optional, default None
+        rows per HDF5 chunk. Defaults to the store's setting
+    
+    Returns
+    -------
+    tables: list
+        list of tables loaded into the file
+    """
+    tables = parse_tables(tables)
+    if not tables:
+        return []
+    if path:
+        h5file = os.path.join(path, h5file)
+    settings = h5_store_settings(h5file)
+    complib = complib or settings['complib']
+    if complevel is None:
+        complevel = settings['complevel']
+    chunkshape = chunkshape or settings['chunkshape']
+    json_files = {}
+    zip_files = {}
+    for table in tables:
+        zip_files[table] = table + '-eng.zip'
+        json_files[table] = table + '.json'
+        if path:
+            zip_files[table] = os.path.join(path, zip_files[table])
+            json_files[table] = os.path.join(path, json_files[table])
+    missing = [t for t in tables if not os.path.isfile(json_files[t])]
+    if missing:
+        download_tables(missing, path)
+    for table in tables:
+        hkey = 'table_' + table
+        jkey = 'json_' + table
+        with open(json_files[table]) as f_name:
+            df_json = json.load(f_name)
+        # Each table is written to a file of its own first, so the store is
+        # only locked while it's copied in. The copy also sets the chunk
+        # shape, which pandas can't
+        staging = '{}.{}.{}.staging'.format(h5file, os.getpid(), table)
+        try:
+            with pd.HDFStore(
+                staging, 'w', complib=complib, complevel=complevel
+            ) as store:
+                if chunksize:
+                    h5_stream_table(
+                        store, hkey, table, path=path, chunksize=chunksize
+                        )
+                else:
+                    df = zip_table_to_dataframe(table, path=path)
+                    # Data columns let rows be selected and upserted by
+                    # series and date
+                    data_columns = [
+                        c for c in H5_DATA_COLUMNS if c in df.columns
+                        ]
+                    with stage('h5_write', table=table) as metrics:
+                        store.put(
+                            hkey, df, format='table',
+                            data_columns=data_columns, index=False
+                            )
+                        store.create_table_index(
+                            hkey, columns=data_columns, optlevel=9,
+                            kind='full'
+                            )
+                        metrics.add(rows=len(df))
+                    del df
+            with h5_store_lock(h5file):
+                h5_copy_tables(staging, h5file, [hkey], chunkshape=chunkshape)
+                with h5py.File(h5file, 'a') as hfile:
+                    if jkey in hfile:
+                        del hfile[jkey]
+                    hfile.create_dataset(jkey, data=json.dumps(df_json))
+                h5_catalog_update(h5file, tables=[table])
+        finally:
+            if os.path.isfile(staging):
+                os.remove(staging)
+    for table in tables:
+        os.remove(zip_files[table])
+        os.remove(json_files[table])
+    return tables
+
+
+def table_from_h5(
+    table, h5file='stats_can.h5', path=None, where=None, columns=None,
+    stop=None
+):
+    """Read a table from h5 to a dataframe
+
+    Parameters
+    ----------
+    table: str
+        name of the table to read
+    h5file: str, default stats_can.h5
+        name of the h5file to retrieve the table from
+    path: str or path, default = current working directory
+        path to the h5file
+    where: str or list of str, optional, default None
+        query on the table's data columns, e.g. "VECTOR in ['v1', 'v2']",
+        so only matching rows are read from disk. Values have to be written
+        into the query, variables aren't looked up
+    columns: list of str, optional, default None
+        only return these columns
+    stop: int, optional, default None
+        only read the table's rows up to this one, where is applied to
+        those rows
+
+    Returns
+    -------
+    df: pd.DataFrame
+        table in dataframe format
+    """
+    product_id = parse_tables(table)[0]
+    table = 'table_' + product_id
+    if path:
+        h5 = os.path.join(path, h5file)
+    else:
+        h5 = h5file
+    # Only whole tables are cached
+    cache_key = None
+    if where is None and columns is None and stop is None:
+        cache_key = (os.path.abspath(h5), product_id)
+        version = h5_table_version(h5, product_id)
+        df = TABLE_CACHE.get(cache_key, version) if version else None
+        if df is not None:
+            h5_record_access(h5, [product_id])
+            return df
+    try:
+        with store_lock(h5), stage('h5_read', table=table) as metrics:
+            df = pd.read_hdf(
+                h5, key=table, where=where, columns=columns, stop=stop
+                )
+            metrics.add(rows=len(df))
+    except KeyError:
+        # Outside the shared lock, tables_to_h5 takes the exclusive one
+        print("Downloading and loading " + table)
+        tables_to_h5(tables=table, h5file=h5file, path=path)
+        if cache_key:
+            version = h5_table_version(h5, product_id)
+        with store_lock(h5), stage('h5_read', table=table) as metrics:
+            df = pd.read_hdf(
+                h5, key=table, where=where, columns=columns, stop=stop
+                )
+            metrics.add(rows=len(df))
+    if cache_key and version:
+        TABLE_CACHE.put(cache_key, version, df)
+    h5_record_access(h5, [product_id])
+    return df
+
+
+def h5_table_version(h5file, table):
+    """Identify the version of a table stored in an h5 file
+
+    Parameters
+    ----------
+    h5file: str or path
+        the h5 file, including its path
+    table: str
+        the table
+
+    Returns
+    -------
+    tuple or None
+        the table's cubeEndDate, releaseTime and row count from the store's
+        catalog, None if it isn't stored
+    """
+    for entry in h5_catalog(h5file):
+        if entry['productId'] == table:
+            return (entry['cubeEndDate'], entry['releaseTime'], entry['rows'])
+    return None
+
+
+def h5_data_columns(table, h5file='stats_can.h5', path=None):
+    """Columns of a stored table that h5 reads can select rows on
+
+    Parameters
+    ----------
+    table: str
+        the table
+    h5file: str, default stats_can.h5
+        name of the h5file
+    path: str or path, default = current working directory
+        path to the h5file
+
+    Returns
+    -------
+    list of str
+        the table's data columns, H5_DATA_COLUMNS if it isn't stored yet,
+        since that's what it will be stored with
+    """
+    table = parse_tables(table)[0]
+    if path:
+        h5file = os.path.join(path, h5file)
+    hkey = 'table_' + table
+    if not os.path.isfile(h5file):
+        return list(H5_DATA_COLUMNS)
+    with store_lock(h5file), pd.HDFStore(h5file, 'r') as store:
+        if hkey not in store:
+            return list(H5_DATA_COLUMNS)
+        return list(store.get_storer(hkey).data_columns or [])
+
+
+def metadata_from_h5(tables, h5file='stats_can.h5', path=None):
+    """Read table metadata from h5
+
+    Parameters
+    ----------
+    table: str or list of str
+        name of the tables to read
+    h5file: str, default stats_can.h5
+        name of the h5file to retrieve the table from
+    path: str or path, default = current working directory
+        path to the h5file
+
+    Returns
+    -------
+    list of local table metadata
+    """
+    if path:
+        h5file = os.path.join(path, h5file)
+    tables = ['json_' + tbl for tbl in parse_tables(tables)]
+    jsons = []
+    with store_lock(h5file), h5py.File(h5file, 'r') as f:
+        for tbl in tables:
+            try:
+                table_json = json.loads(f[tbl][()])
+                jsons += [table_json]
+            except KeyError:
+                print("Couldn't find table " + tbl)
+    return jsons
+
+
+def h5_catalog_entry(hfile, table, last_write=None):
+    """Summarize a table in an open h5 file for the store's catalog
+
+    Parameters
+    ----------
+    hfile: h5py.File
+        open h5 file holding the table
+    table: str
+        the table to summarize
+    last_write: str, optional, default None
+        ISO timestamp the table was last written, now if None
+
+    Returns
+    -------
+    dict
+        productId, cubeEndDate, releaseTime, rows, bytes and lastWrite
+    """
+    hkey = 'table_' + table
+    metadata = json.loads(hfile['json_' + table][()])
+    sizes = []
+    hfile[hkey].visititems(
+        lambda name, obj: sizes.append(obj.id.get_storage_size())
+        if isinstance(obj, h5py.Dataset) else None
+        )
+    return {
+        'productId': table,
+        'cubeEndDate': metadata.get('cubeEndDate'),
+        'releaseTime': metadata.get('releaseTime', ''),
+        'rows': int(hfile[hkey]['table'].shape[0]),
+        'bytes': int(sum(sizes)),
+        'lastWrite': last_write or dt.datetime.now().isoformat(
+            timespec='seconds'
+            )
+        }
+
+
+def h5_catalog_update(h5file, tables=None, removed=None, in_place=False):
+    """Bring the catalog of an h5 store up to date after a change
+
+    Rebuilt from every table in the file if it isn't there yet. Call it
+    holding h5_store_lock, or on the new file from h5_store_writer.
+
+    The catalog also counts the bytes of tables replaced or deleted since
+    the store was last compacted. HDF5 doesn't reuse that space, so it's
+    what compacting would give back, see h5_space_usage.
+
+    Parameters
+    ----------
+    h5file: str or path
+        the h5 file, including its path
+    tables: list of str, optional, default None
+        tables written, summarized again
+    removed: list of str, optional, default None
+        tables deleted, dropped from the catalog
+    in_place: bool, default False
+        tables were updated in place rather than deleted and written again,
+        so the space they used isn't freed
+    """
+    with h5py.File(h5file, 'a') as hfile:
+        freed_bytes = 0
+        if H5_CATALOG_KEY in hfile:
+            catalog = json.loads(hfile[H5_CATALOG_KEY][()])
+            freed_bytes = int(
+                hfile[H5_CATALOG_KEY].attrs.get('freed_bytes', 0)
+                )
+        else:
+            catalog = {}
+            stored = parse_tables(
+                [key for key in hfile.keys() if key.startswith('json_')]
+                )
+            tables = [t for t in stored if 'table_' + t in hfile]
+        for table in tables or []:
+            if table in catalog and not in_place:
+                freed_bytes += catalog[table]['bytes']
+            catalog[table] = h5_catalog_entry(hfile, table)
+        for table in removed or []:
+            if table in catalog:
+                freed_bytes += catalog.pop(table)['bytes']
+        if H5_CATALOG_KEY in hfile:
+            del hfile[H5_CATALOG_KEY]
+        hfile.create_dataset(H5_CATALOG_KEY, data=json.dumps(catalog))
+        hfile[H5_CATALOG_KEY].attrs['freed_bytes'] = freed_bytes
+
+
+def h5_catalog(h5file='stats_can.h5', path=None):
+    """Return the catalog of tables in an h5 store
+
+    The catalog is one small dataset kept up to date by every write and
+    delete, so listing the store doesn't have to open each table's metadata.
+    Stores written before the catalog existed get one the next time they're
+    written to, until then it's worked out from the tables on every call.
+    Last access times come from the side file kept by h5_record_access.
+
+    Parameters
+    ----------
+    h5file: str, default stats_can.h5
+        name of the h5file
+    path: str or path, default = current working directory
+        path to the h5file
+
+    Returns
+    -------
+    list of dict
+        one entry per table, sorted by productId, with its productId,
+        cubeEndDate, releaseTime, rows, bytes on disk, lastWrite and
+        lastAccess, the later of when it was last written or read
+    """
+    if path:
+        h5file = os.path.join(path, h5file)
+    if not os.path.isfile(h5file):
+        return []
+    with store_lock(h5file), h5py.File(h5file, 'r') as hfile:
+        if H5_CATALOG_KEY in hfile:
+            catalog = json.loads(hfile[H5_CATALOG_KEY][()])
+        else:
+            stored = parse_tables(
+                [key for key in hfile.keys() if key.startswith('json_')]
+                )
+            catalog = {
+                table: h5_catalog_entry(hfile, table)
+                for table in stored if 'table_' + table in hfile
+                }
+    access = h5_access_times(h5file)
+    entries = []
+    for table in sorted(catalog):
+        entry = dict(catalog[table])
+        entry['lastAccess'] = max(
+            entry.get('lastWrite', ''), access.get(table, '')
+            )
+        entries.append(entry)
+    return entries
+
+
+def h5_access_times(h5file):
+    """Read the last access times kept next to an h5 store
+
+    Parameters
+    ----------
+    h5file: str or path
+        the h5 file, including its path
+
+    Returns
+    -------
+    dict
+        productId mapped to an ISO timestamp, empty if there are none
+    """
+    try:
+        with open(str(h5file) + '.access.json') as f_name:
+            return json.load(f_name)
+    except (OSError, ValueError):
+        return {}
+
+
+def h5_record_access(h5file, tables):
+    """Note that tables in an h5 store were just read
+
+    Times go in a small json file next to the store rather than in it, so
+    reads never write to the store and work on stores the user can only
+    read. Best effort, concurrent readers can overwrite each other's times
+    and nothing is recorded if the file can't be written.
+
+    Parameters
+    ----------
+    h5file: str or path
+        the h5 file, including its path
+    tables: list of str
+        tables read
+    """
+    access_file = str(h5file) + '.access.json'
+    access = h5_access_times(h5file)
+    now = dt.datetime.now().isoformat(timespec='seconds')
+    access.update(dict.fromkeys(tables, now))
+    part = '{}.{}.part'.format(access_file, os.getpid())
+    try:
+        with open(part, 'w') as outfile:
+            json.dump(access, outfile)
+        os.replace(part, access_file)
+    except OSError:
+        if os.path.isfile(part):
+            os.remove(part)
+
+
+def h5_store_settings(h5file='stats_can.h5', path=None):
+    """Return the compression settings new tables in an h5 store get
+
+    Parameters
+    ----------
+    h5file: str, default stats_can.h5
+        name of the h5file
+    path: str or path, default = current working directory
+        path to the h5file
+
+    Returns
+    -------
+    dict
+        complib, complevel and chunkshape, from the store if they were set
+        with set_h5_store_settings and the H5_ module defaults otherwise
+    """
+    if path:
+        h5file = os.path.join(path, h5file)
+    settings = {
+        'complib': H5_COMPLIB,
+        'complevel': H5_COMPLEVEL,
+        'chunkshape': H5_CHUNKSHAPE
+        }
+    if os.path.isfile(h5file):
+        with store_lock(h5file), h5py.File(h5file, 'r') as hfile:
+            if H5_SETTINGS_KEY in hfile:
+                settings.update(json.loads(hfile[H5_SETTINGS_KEY][()]))
+    return settings
+
+
+def set_h5_store_settings(
+    h5file='stats_can.h5', path=None, complib=None, complevel=None,
+    chunkshape=None
+):
+    """Choose the compression settings for new tables in an h5 store
+
+    Tables already in the store keep theirs until it's compacted, see
+    compact_h5. Settings left as None keep their current value.
+
+    Parameters
+    ----------
+    h5file: str, default stats_can.h5
+        name of the h5file, created if it doesn't exist
+    path: str or path, default = current working directory
+        path to the h5file
+    complib: str, optional, default None
+        compression library, anything PyTables supports, e.g. zlib, lzo,
+        blosc, blosc:lz4 or blosc:zstd
+    complevel: int, optional, default None
+        compression level from 0 (none) to 9
+    chunkshape: int, optional, default None
+        rows per HDF5 chunk, 0 to let PyTables pick
+
+    Returns
+    -------
+    dict
+        the store's settings after the change
+    """
+    if path:
+        h5file = os.path.join(path, h5file)
+    settings = h5_store_settings(h5file)
+    if complib is not None:
+        if not tb.which_lib_version(complib.split(':')[0]):
+            raise ValueError('Compression library not available: ' + complib)
+        settings['complib'] = complib
+    if complevel is not None:
+        settings['complevel'] = complevel
+    if chunkshape is not None:
+        settings['chunkshape'] = chunkshape or None
+    with h5_store_lock(h5file), h5py.File(h5file, 'a') as hfile:
+        if H5_SETTINGS_KEY in hfile:
+            del hfile[H5_SETTINGS_KEY]
+        hfile.create_dataset(H5_SETTINGS_KEY, data=json.dumps(settings))
+    return settings
+
+
+def list_h5_tables(path=None, h5file='stats_can.h5'):
+    """return a list of metadata for StatsCan tables from an hdf5 file
+
+    Parameters
+    ----------
+    path: str or path, default = current working directory
+        path to the h5 file
+    h5file: str, default stats_can.h5
+        name of the h5file to read table data from
+    
+    Returns
+    -------
+    jsons: list
+        list of available tables json data
+    """
+    tables = [
+        entry['productId'] for entry in h5_catalog(h5file=h5file, path=path)
+        ]
+    jsons = metadata_from_h5(tables, h5file=h5file, path=path)
+    return jsons
+
+
+def is_parquet_store(h5file):
+    """Whether a store name refers to a parquet store rather than hdf5
+
+    Parameters
+    ----------
+    h5file: str or None
+        name of the store, parquet stores are directories ending in .parquet
+
+    Returns
+    -------
+    bool
+    """
+    return bool(h5file) and str(h5file).endswith('.parquet')
+
+
+def parquet_store_files(table, store='stats_can.parquet', path=None):
+    """Paths to the data and metadata files for a table in a parquet store
+
+    Parameters
+    ----------
+    table: str
+        the table
+    store: str, default stats_can.parquet
+        name of the parquet store directory
+    path: str or path, default = current working directory
+        path to the store
+
+    Returns
+    -------
+    data_file, json_file: str
+        where the table data and its metadata are kept
+    """
+    table = parse_tables(table)[0]
+    if path:
+        store = os.path.join(path, store)
+    return (
+        os.path.join(store, table + '.parquet'),
+        os.path.join(store, table + '.json')
+        )
+
+
+def tables_to_parquet(tables, store='stats_can.parquet', path=None):
+    """Take a table and its metadata and put it in a parquet store
+
+    Each table is written to its own parquet file, sorted by VECTOR and
+    REF_DATE in row groups of PARQUET_ROW_GROUP_SIZE rows, so row group
+    statistics let filtered reads skip most of the file. Its metadata is
+    kept in a json file alongside.
 
     Parameters
     ----------
     tables: list of str
-        tables to add to the h5file
-    h5file: str, default stats_can.h5
-        name of the h5file to store the tables in
+        tables to add to the store
+    store: str, default stats_can.parquet
+        name of the parquet store directory
     path: str or path, default = current working directory
-        path to the h5file
-    
+        path to the store
+
     Returns
     -------
     tables: list
-        list of tables loaded into the file
+        list of tables loaded into the store
     """
-    if path:
-        h5file = os.path.join(path, h5file)
     tables = parse_tables(tables)
+    os.makedirs(os.path.join(path, store) if path else store, exist_ok=True)
     for table in tables:
-        hkey = 'table_' + table
-        jkey = 'json_' + table
+        data_file, store_json = parquet_store_files(table, store, path)
         zip_file = table + '-eng.zip'
         json_file = table + '.json'
         if path:
@@ -272,124 +1810,298 @@ def tables_to_h5(tables, h5file='stats_can.h5', path=None):
         if not os.path.isfile(json_file):
             download_tables([table], path)
         df = zip_table_to_dataframe(table, path=path)
-        with open(json_file) as f_name:
-            df_json = json.load(f_name)
-        df.to_hdf(h5file, key=hkey, format='table', complevel=1)
-        with h5py.File(h5file, 'a') as hfile:
-            if jkey in hfile.keys():
-                del hfile[jkey]
-            hfile.create_dataset(jkey, data=json.dumps(df_json))
+        sort_cols = [c for c in ['VECTOR', 'REF_DATE'] if c in df.columns]
+        if sort_cols:
+            df = df.sort_values(sort_cols, ignore_index=True)
+        with stage('parquet_write', table=table) as metrics:
+            df.to_parquet(
+                data_file + '.part',
+                engine='pyarrow',
+                index=False,
+                row_group_size=PARQUET_ROW_GROUP_SIZE
+                )
+            os.replace(data_file + '.part', data_file)
+            metrics.add(rows=len(df), bytes=os.path.getsize(data_file))
+        os.replace(json_file, store_json)
         os.remove(zip_file)
-        os.remove(json_file)
     return tables
 
 
-def table_from_h5(table, h5file='stats_can.h5', path=None):
-    """Read a table from h5 to a dataframe
+def table_from_parquet(
+    table, store='stats_can.parquet', path=None, columns=None, filters=None
+):
+    """Read a table from a parquet store to a dataframe
 
     Parameters
     ----------
     table: str
         name of the table to read
-    h5file: str, default stats_can.h5
-        name of the h5file to retrieve the table from
+    store: str, default stats_can.parquet
+        name of the parquet store directory
     path: str or path, default = current working directory
-        path to the h5file
+        path to the store
+    columns: list of str, optional, default None
+        only read these columns
+    filters: list of tuples, optional, default None
+        pyarrow filters, e.g. [('GEO', '==', 'Canada')], row groups that
+        can't match are skipped using their statistics
 
     Returns
     -------
     df: pd.DataFrame
         table in dataframe format
     """
-    table = 'table_' + parse_tables(table)[0]
-    if path:
-        h5 = os.path.join(path, h5file)
-    else:
-        h5 = h5file
-    try:
-        df = pd.read_hdf(h5, key=table)
-    except KeyError:
-        print("Downloading and loading " + table)
-        tables_to_h5(tables=table, h5file=h5file, path=path)
-        df = pd.read_hdf(h5, key=table)
+    data_file, _ = parquet_store_files(table, store, path)
+    if not os.path.isfile(data_file):
+        print("Downloading and loading " + parse_tables(table)[0])
+        tables_to_parquet(tables=table, store=store, path=path)
+    # Only whole tables are cached, files are replaced when tables update
+    cache_key = None
+    if columns is None and filters is None:
+        cache_key = (os.path.abspath(data_file),)
+        version = os.path.getmtime(data_file)
+        df = TABLE_CACHE.get(cache_key, version)
+        if df is not None:
+            return df
+    with stage('parquet_read', table=parse_tables(table)[0]) as metrics:
+        df = pd.read_parquet(
+            data_file, engine='pyarrow', columns=columns, filters=filters
+            )
+        metrics.add(rows=len(df))
+    if cache_key:
+        TABLE_CACHE.put(cache_key, version, df)
     return df
 
 
-def metadata_from_h5(tables, h5file='stats_can.h5', path=None):
-    """Read table metadata from h5
+def metadata_from_parquet(tables, store='stats_can.parquet', path=None):
+    """Read table metadata from a parquet store
 
     Parameters
     ----------
-    table: str or list of str
+    tables: str or list of str
         name of the tables to read
-    h5file: str, default stats_can.h5
-        name of the h5file to retrieve the table from
+    store: str, default stats_can.parquet
+        name of the parquet store directory
     path: str or path, default = current working directory
-        path to the h5file
+        path to the store
 
     Returns
     -------
     list of local table metadata
     """
-    if path:
-        h5file = os.path.join(path, h5file)
-    tables = ['json_' + tbl for tbl in parse_tables(tables)]
     jsons = []
-    with h5py.File(h5file, 'r') as f:
-        for tbl in tables:
-            try:
-                table_json = json.loads(f[tbl][()])
-                jsons += [table_json]
-            except KeyError:
-                print("Couldn't find table " + tbl)
+    for tbl in parse_tables(tables):
+        _, json_file = parquet_store_files(tbl, store, path)
+        try:
+            with open(json_file) as f_name:
+                jsons.append(json.load(f_name))
+        except FileNotFoundError:
+            print("Couldn't find table " + tbl)
     return jsons
 
 
-def list_h5_tables(path=None, h5file='stats_can.h5'):
-    """return a list of metadata for StatsCan tables from an hdf5 file
+def list_parquet_tables(path=None, store='stats_can.parquet'):
+    """return a list of metadata for StatsCan tables in a parquet store
 
     Parameters
     ----------
     path: str or path, default = current working directory
-        path to the h5 file
-    h5file: str, default stats_can.h5
-        name of the h5file to read table data from
-    
+        path to the store
+    store: str, default stats_can.parquet
+        name of the parquet store directory
+
     Returns
     -------
     jsons: list
         list of available tables json data
     """
-    keys = h5_included_keys(h5file=h5file, path=path)
-    tables = parse_tables([k for k in keys if k.startswith('json_')])
-    jsons = metadata_from_h5(tables, h5file=h5file, path=path)
-    return jsons
+    store_dir = os.path.join(path, store) if path else store
+    if not os.path.isdir(store_dir):
+        return []
+    tables = [
+        f[:-len('.json')] for f in os.listdir(store_dir)
+        if f.endswith('.json')
+        ]
+    return metadata_from_parquet(tables, store=store, path=path)
+
+
+def parquet_update_tables(store='stats_can.parquet', path=None, tables=None):
+    """update any stats_can tables contained in a parquet store
+
+    Parameters
+    ----------
+    store: str, default stats_can.parquet
+        name of the parquet store directory
+    path: str or path, default = current working directory
+        path to the store
+    tables: str or list of str, optional, default None
+        If included will only update the subset of tables already in the
+        store and in the tables parameter
+
+    Returns
+    -------
+    update_table_list: list of str
+        list of updated tables
+    """
+    if tables:
+        local_jsons = metadata_from_parquet(tables, store=store, path=path)
+    else:
+        local_jsons = list_parquet_tables(path=path, store=store)
+    tables = [j['productId'] for j in local_jsons]
+    remote_jsons = cached_cube_metadata(tables, path=path)
+    update_table_list = []
+    for local, remote in zip(local_jsons, remote_jsons):
+        if local['cubeEndDate'] != remote['cubeEndDate']:
+            update_table_list.append(local['productId'])
+    tables_to_parquet(update_table_list, store=store, path=path)
+    return update_table_list
 
 
 def list_downloaded_tables(path=None, h5file='stats_can.h5'):
     """Return a list of metadata for StatsCan tables
 
-    Wrapper for list zipped tables and list h5 tables
+    Wrapper for list zipped tables, list h5 tables and list parquet tables
 
     Parameters
     ----------
     path: str or path, default = current working directory
         path to the h5 file
     h5file: str, default stats_can.h5
-        name of the h5file to read table data from
+        name of the h5file to read table data from, a name ending in .parquet
+        for a parquet store
     
     Returns
     -------
     jsons: list
         list of available tables json data
     """
-    if h5file:
+    if is_parquet_store(h5file):
+        jsons = list_parquet_tables(path=path, store=h5file)
+    elif h5file:
         jsons = list_h5_tables(path=path, h5file=h5file)
     else:
         jsons = list_zipped_tables(path=path)
     return jsons
 
-def h5_update_tables(h5file='stats_can.h5', path=None, tables=None):
+def h5_apply_changed_data(
+    table, series_data, metadata, h5file='stats_can.h5', path=None
+):
+    """Upsert changed data points into a table already in an h5 file
+
+    Data points for periods already stored have their VALUE replaced, new
+    periods are added by copying the latest stored row for the series with
+    the new REF_DATE and VALUE and a blank STATUS, SYMBOL and TERMINATED.
+    Only the affected rows are rewritten. The table's metadata is replaced
+    with metadata once the data is in.
+
+    Parameters
+    ----------
+    table: str
+        the table to update
+    series_data: list of dicts
+        output of get_changed_series_data_from_vector for the table's series
+    metadata: dict
+        current cube metadata for the table
+    h5file: str, default stats_can.h5
+        name of the h5file the table is stored in
+    path: str or path, default = current working directory
+        path to the h5file
+
+    Returns
+    -------
+    bool
+        True if the changes were applied, False if the table needs a full
+        reload instead, because it was stored without data columns or a
+        series in the changes isn't in it yet
+    """
+    table = parse_tables(table)[0]
+    hkey = 'table_' + table
+    jkey = 'json_' + table
+    if path:
+        h5file = os.path.join(path, h5file)
+    points = [
+        {
+            'VECTOR': 'v' + str(series['vectorId']),
+            'REF_DATE': point['refPer'],
+            'VALUE': point['value']
+        }
+        for series in series_data
+        for point in series['vectorDataPoint']
+        ]
+    # Stores written without data columns can't be upserted
+    with store_lock(h5file), pd.HDFStore(h5file, 'r') as store:
+        if 'VECTOR' not in (store.get_storer(hkey).data_columns or []):
+            return False
+    # Changed in place. New rows go in before the rows they replace come
+    # out, and the metadata and catalog are written last, so a failure part
+    # way leaves the old data, or at worst both copies of a row, with the
+    # old metadata
+    missing = False
+    with h5_store_lock(h5file):
+        with pd.HDFStore(h5file, 'a') as store:
+            storer = store.get_storer(hkey)
+            if points:
+                changes = pd.DataFrame(points)
+                changes['REF_DATE'] = pd.to_datetime(changes['REF_DATE'])
+                changes = changes.drop_duplicates(
+                    ['VECTOR', 'REF_DATE'], keep='last'
+                    )
+                vec_names = list(changes['VECTOR'].unique())
+                coords = store.select_as_coordinates(
+                    hkey, where='VECTOR in vec_names'
+                    )
+                existing = store.select(hkey, where=coords)
+                existing_vectors = existing['VECTOR'].astype(str)
+                missing = not set(vec_names).issubset(existing_vectors)
+                if not missing:
+                    stored_key = pd.MultiIndex.from_arrays(
+                        [existing_vectors, existing['REF_DATE']]
+                        )
+                    change_key = pd.MultiIndex.from_arrays(
+                        [changes['VECTOR'], changes['REF_DATE']]
+                        )
+                    new_values = pd.Series(
+                        changes['VALUE'].values, index=change_key
+                        )
+                    replaced = stored_key.isin(change_key)
+                    updated = existing[replaced].copy()
+                    updated['VALUE'] = new_values.reindex(
+                        stored_key[replaced]
+                        ).values
+                    new_periods = changes[~change_key.isin(stored_key)]
+                    latest = (
+                        existing.sort_values('REF_DATE')
+                        .drop_duplicates('VECTOR', keep='last')
+                        )
+                    latest.index = latest['VECTOR'].astype(str)
+                    added = latest.loc[new_periods['VECTOR']].copy()
+                    added['REF_DATE'] = new_periods['REF_DATE'].values
+                    added['VALUE'] = new_periods['VALUE'].values
+                    for col in ['STATUS', 'SYMBOL', 'TERMINATED']:
+                        if col in added.columns:
+                            added[col] = pd.Series(
+                                np.nan, index=added.index
+                                ).astype(added[col].dtype)
+                    added.index = pd.RangeIndex(
+                        storer.nrows, storer.nrows + len(added)
+                        )
+                    # New rows go in before the old ones come out
+                    store.append(hkey, pd.concat([updated, added]))
+                    if replaced.any():
+                        store.remove(hkey, where=coords[replaced])
+        if missing:
+            return False
+        with h5py.File(h5file, 'a') as hfile:
+            if jkey in hfile.keys():
+                del hfile[jkey]
+            hfile.create_dataset(jkey, data=json.dumps(metadata))
+        h5_catalog_update(h5file, tables=[table], in_place=True)
+    return True
+
+
+def h5_update_tables(
+    h5file='stats_can.h5', path=None, tables=None, delta=False
+):
     """update any stats_can tables contained in an h5 file
 
     Parameters
@@ -401,58 +2113,108 @@ def h5_update_tables(h5file='stats_can.h5', path=None, tables=None):
     tables: str or list of str, optional, default None
         If included will only update the subset of tables already in the file
         and in the tables parameter
+    delta: boolean, default False
+        If True, tables whose only release since they were stored came out
+        today are updated in place with just today's changed data points
+        (see h5_apply_changed_data). Anything else is reloaded in full
     """
+    # The catalog carries the productId, cubeEndDate and releaseTime needed
+    # here without decoding each table's metadata
+    local_jsons = h5_catalog(h5file=h5file, path=path)
     if tables:
-        local_jsons = metadata_from_h5(tables, h5file=h5file, path=path)
-    else:
-        if path:
-            h5 = os.path.join(path, h5file)
-        else:
-            h5 = h5file
-        with h5py.File(h5) as f:
-            keys = [key for key in f.keys() if key.startswith('json')]
-            local_jsons = [json.loads(f[key][()]) for key in keys]
+        tables = parse_tables(tables)
+        local_jsons = [j for j in local_jsons if j['productId'] in tables]
     tables = [j['productId'] for j in local_jsons]
-    remote_jsons = get_cube_metadata(tables)
+    remote_jsons = cached_cube_metadata(tables, path=path)
     update_table_list = []
     for local, remote in zip(local_jsons, remote_jsons):
         if local['cubeEndDate'] != remote['cubeEndDate']:
             update_table_list.append(local['productId'])
-    tables_to_h5(update_table_list, h5file=h5file, path=path)
+    full_update_list = update_table_list
+    if delta and update_table_list:
+        full_update_list = []
+        today = dt.date.today()
+        changed_vectors = {}
+        for series in get_changed_series_list():
+            table = parse_tables(str(series['productId']))[0]
+            changed_vectors.setdefault(table, []).append(series['vectorId'])
+        # Tables changed between a stored release and today, by release date
+        changed_since = {}
+        metas = {
+            local['productId']: (local, remote)
+            for local, remote in zip(local_jsons, remote_jsons)
+            }
+        for table in update_table_list:
+            local, remote = metas[table]
+            release = local.get('releaseTime', '')[:10]
+            safe = False
+            if release and table in changed_vectors:
+                start = dt.date.fromisoformat(release) + dt.timedelta(days=1)
+                end = today - dt.timedelta(days=1)
+                if (today - start).days <= METADATA_CACHE_MAX_DAYS:
+                    if start not in changed_since:
+                        changed_since[start] = (
+                            tables_changed_between(start, end)
+                            if start <= end else set()
+                            )
+                    safe = table not in changed_since[start]
+            if safe:
+                series_data = get_changed_series_data_from_vector(
+                    changed_vectors[table]
+                    )
+                if h5_apply_changed_data(
+                    table, series_data, remote, h5file=h5file, path=path
+                ):
+                    continue
+            full_update_list.append(table)
+    if full_update_list:
+        tables_to_h5(full_update_list, h5file=h5file, path=path)
+    if update_table_list and H5_COMPACT_DEAD_RATIO is not None:
+        compact_h5(h5file, path=path, threshold=H5_COMPACT_DEAD_RATIO)
     return update_table_list
 
 
-def update_tables(path=None, h5file='stats_can.h5', tables=None, csv=True):
+def update_tables(
+    path=None, h5file='stats_can.h5', tables=None, csv=True, delta=False
+):
     """Update downloaded tables where required
 
     Reads local metadata, either from json files or stored in an h5 file,
     compares it to the metadata on the StatsCan website and downloads those
     tables that don't have matching metadata
 
-    Just a wrapper for zip_update tables and h5_update_tables functions
+    Just a wrapper for zip_update tables, h5_update_tables and
+    parquet_update_tables functions
 
     Parameters
     ----------
     path: str or path, default None
         Path where local tables are stored, assumes current directory if None
     h5file: str, default 'stats_can.h5'
-        Name of the h5 file storing StatsCan tables, set to None for zips
+        Name of the h5 file storing StatsCan tables, set to None for zips or
+        a name ending in .parquet for a parquet store
     tables: list of str, default None
         For hdf5 only, update only a subset of tables that are both in the file
         and specified by this argument, None means update all tables
     csv: boolean, default True
         If updating zips this determines whether to update zipped CSV or SDMX
+    delta: boolean, default False
+        For hdf5 only, apply today's changed data points in place where
+        possible instead of reloading whole tables
     
     Returns
     -------
     update_table_list: list of str
         list of updated tables
     """
-    if h5file:
+    if is_parquet_store(h5file):
+        return parquet_update_tables(store=h5file, path=path, tables=tables)
+    elif h5file:
         return h5_update_tables(
             h5file=h5file,
             path=path,
-            tables=tables
+            tables=tables,
+            delta=delta
         )
     else:
         return zip_update_tables(path=path, csv=csv)
@@ -475,11 +2237,137 @@ def h5_included_keys(h5file='stats_can.h5', path=None):
     """
     if path:
         h5file = os.path.join(path, h5file)
-    with h5py.File(h5file, 'r') as f:
+    with store_lock(h5file), h5py.File(h5file, 'r') as f:
         keys = [key for key in f.keys()]
     return keys
 
 
+def h5_space_usage(h5file='stats_can.h5', path=None):
+    """Report how much of an h5 store is dead space
+
+    HDF5 doesn't give back the space of deleted or replaced datasets, so
+    the file grows with every update. Dead space is what those tables took,
+    as counted in the catalog since the store was last compacted, so a
+    fresh store has none however much the file's own bookkeeping and the
+    tables' indexes take. Stores without a catalog report none.
+
+    Parameters
+    ----------
+    h5file: str, default stats_can.h5
+        name of the h5file
+    path: str or path, default = current working directory
+        path to the h5file
+
+    Returns
+    -------
+    dict
+        file_bytes, dead_bytes and dead_ratio, the share of the file that
+        compacting would give back
+    """
+    if path:
+        h5file = os.path.join(path, h5file)
+    dead_bytes = 0
+    with store_lock(h5file), h5py.File(h5file, 'r') as hfile:
+        if H5_CATALOG_KEY in hfile:
+            dead_bytes = int(
+                hfile[H5_CATALOG_KEY].attrs.get('freed_bytes', 0)
+                )
+        file_bytes = os.path.getsize(h5file)
+    return {
+        'file_bytes': file_bytes,
+        'dead_bytes': dead_bytes,
+        'dead_ratio': min(dead_bytes / file_bytes, 1.0) if file_bytes else 0.0
+        }
+
+
+def compact_h5(
+    h5file='stats_can.h5', path=None, complib=None, complevel=None,
+    chunkshape=None, threshold=None
+):
+    """Rewrite the live tables of an h5 store into a fresh file
+
+    Tables are copied into a new file next to the store with the given
+    compression and chunk shape, their indexes rebuilt, and the new file
+    then replaces the old one with a rename. Other writers wait on the
+    writer's lock for the whole rewrite, readers keep reading the old file
+    and only wait for the rename. The old file is left alone if anything
+    fails.
+
+    Parameters
+    ----------
+    h5file: str, default stats_can.h5
+        name of the h5file
+    path: str or path, default = current working directory
+        path to the h5file
+    complib: str, optional, default None
+        compression library to rewrite tables with, anything PyTables
+        supports, e.g. zlib, blosc:lz4 or blosc:zstd. Defaults to the
+        store's setting, see set_h5_store_settings. Settings given here
+        become the store's settings
+    complevel: int, optional, default None
+        compression level, 0 for none. Defaults to the store's setting
+    chunkshape: int, optional, default None
+        rows per HDF5 chunk. Defaults to the store's setting
+    threshold: float, optional, default None
+        only compact if at least this share of the file is dead space (see
+        h5_space_usage), None to always compact
+
+    Returns
+    -------
+    dict
+        before_bytes, after_bytes and reclaimed_bytes, or None if the store
+        was under the threshold
+    """
+    if path:
+        h5file = os.path.join(path, h5file)
+    if threshold is not None:
+        if h5_space_usage(h5file)['dead_ratio'] < threshold:
+            return None
+    settings = h5_store_settings(h5file)
+    settings['complib'] = complib or settings['complib']
+    if complevel is not None:
+        settings['complevel'] = complevel
+    settings['chunkshape'] = chunkshape or settings['chunkshape']
+    filters = tb.Filters(
+        complevel=settings['complevel'], complib=settings['complib']
+        )
+    with h5_store_writer(h5file) as compacted:
+        before_bytes = os.path.getsize(h5file)
+        with h5py.File(h5file, 'r') as src:
+            keys = [key for key in src.keys() if key.startswith('table_')]
+        h5_copy_tables(
+            h5file, compacted, keys, filters=filters,
+            chunkshape=settings['chunkshape']
+            )
+        # Table metadata, the catalog and settings are plain h5py datasets,
+        # safe to copy with h5py unlike PyTables' tables
+        with h5py.File(h5file, 'r') as src:
+            with h5py.File(compacted, 'a') as dst:
+                dst.create_dataset(H5_SETTINGS_KEY, data=json.dumps(settings))
+                for key in src.keys():
+                    if key.startswith('json_') or key == H5_CATALOG_KEY:
+                        src.copy(src[key], dst, name=key)
+                if H5_CATALOG_KEY in dst:
+                    catalog = json.loads(dst[H5_CATALOG_KEY][()])
+                    catalog = {
+                        table: h5_catalog_entry(
+                            dst, table, entry.get('lastWrite')
+                            )
+                        for table, entry in catalog.items()
+                        }
+                    del dst[H5_CATALOG_KEY]
+                    dst.create_dataset(
+                        H5_CATALOG_KEY, data=json.dumps(catalog)
+                        )
+                    dst[H5_CATALOG_KEY].attrs['freed_bytes'] = 0
+    after_bytes = os.path.getsize(h5file)
+    return {
+        'before_bytes': before_bytes,
+        'after_bytes': after_bytes,
+        'reclaimed_bytes': before_bytes - after_bytes
+        }
+
+
 def delete_tables(tables, path=None, h5file='stats_can.h5', csv=True):
     """Delete downloaded tables
 
@@ -490,7 +2378,8 @@ def delete_tables(tables, path=None, h5file='stats_can.h5', csv=True):
     path: str or os path object, default None
         where to look for the tables to delete
     h5file: str default stats_can.h5
-        h5file to remove from, set to None to remove zips
+        h5file to remove from, set to None to remove zips or a name ending in
+        .parquet for a parquet store
     csv: boolean, default True
         if h5file is None this specifies whether to delete zipped csv or SDMX
     
@@ -500,10 +2389,20 @@ def delete_tables(tables, path=None, h5file='stats_can.h5', csv=True):
         list of deleted tables
     """
     clean_tables = parse_tables(tables)
-    available_tables_jsons = list_downloaded_tables(path=path, h5file=h5file)
+    if h5file and not is_parquet_store(h5file):
+        available_tables_jsons = h5_catalog(h5file=h5file, path=path)
+    else:
+        available_tables_jsons = list_downloaded_tables(
+            path=path, h5file=h5file
+            )
     available_tables = [j['productId'] for j in available_tables_jsons]
     to_delete = [t for t in clean_tables if t in available_tables]
-    if h5file:
+    if is_parquet_store(h5file):
+        for td in to_delete:
+            for file in parquet_store_files(td, h5file, path):
+                if os.path.exists(file):
+                    os.remove(file)
+    elif h5file:
         keys_to_del = []
         for td in to_delete:
             json_to_del = 'json_' + td
@@ -512,9 +2411,13 @@ def delete_tables(tables, path=None, h5file='stats_can.h5', csv=True):
             keys_to_del.append(tbl_to_del)
         if path:
             h5file = os.path.join(path, h5file)
-        with h5py.File(h5file, 'a') as f:
-            for k in keys_to_del:
-                del f[k]
+        with h5_store_lock(h5file):
+            with h5py.File(h5file, 'a') as f:
+                for k in keys_to_del:
+                    del f[k]
+            h5_catalog_update(h5file, removed=to_delete)
+        if H5_COMPACT_DEAD_RATIO is not None:
+            compact_h5(h5file, threshold=H5_COMPACT_DEAD_RATIO)
     else:
         files_to_del = []
         for td in to_delete:
@@ -533,34 +2436,260 @@ def delete_tables(tables, path=None, h5file='stats_can.h5', csv=True):
     return to_delete
     
 
-def table_to_df(table, path=None, h5file='stats_can.h5'):
+def table_to_df(table, path=None, h5file='stats_can.h5', lazy=False):
     """Read a table to a dataframe
 
-    Wrapper for table_from_h5 and zip_table_to_dataframe
+    Wrapper for table_from_h5, table_from_parquet and zip_table_to_dataframe
 
     Parameters
     ----------
     table: str
         name of the table to read
     h5file: str, default stats_can.h5
-        name of the h5file to retrieve the table from, None for zip
+        name of the h5file to retrieve the table from, None for zip or a name
+        ending in .parquet for a parquet store
     path: str or path, default = current working directory
         path to the table data
+    lazy: bool, default False
+        return a LazyTable that reads nothing until it's computed, so
+        columns, filters and aggregations can be added first and pushed
+        down to the read
 
     Returns
     -------
-    df: pd.DataFrame
+    df: pd.DataFrame or LazyTable
         table in dataframe format
     """
-    if h5file:
+    if lazy:
+        return LazyTable(table, path=path, h5file=h5file)
+    if is_parquet_store(h5file):
+        df = table_from_parquet(table=table, store=h5file, path=path)
+    elif h5file:
         df = table_from_h5(table=table, h5file=h5file, path=path)
     else:
-        df = zip_table_to_dataframe(table=table, path=path)
+        zip_file = parse_tables(table)[0] + '-eng.zip'
+        if path:
+            zip_file = os.path.join(path, zip_file)
+        if os.path.isfile(zip_file):
+            cache_key = (os.path.abspath(zip_file),)
+            version = os.path.getmtime(zip_file)
+            df = TABLE_CACHE.get(cache_key, version)
+            if df is None:
+                df = zip_table_to_dataframe(table=table, path=path)
+                TABLE_CACHE.put(cache_key, version, df)
+        else:
+            df = zip_table_to_dataframe(table=table, path=path)
     return df
 
 
+class LazyTable:
+    """A stored table that's only read when computed
+
+    Each method returns a new LazyTable with the operation added, nothing
+    is read until compute(). Column selections and filters on the table's
+    data columns (H5_DATA_COLUMNS when it was stored) are pushed into the
+    read of an h5 store, every filter into the read of a parquet store, and
+    zipped tables are filtered a chunk at a time, so only the rows and
+    columns asked for are held in memory. Filters on other columns of an h5
+    table are applied after the read.
+
+    Example:
+        (table_to_df('18100004', lazy=True)
+         .filter('GEO', ['Canada', 'Ontario'])
+         .dates(start='2015-01-01')
+         .select(['REF_DATE', 'GEO', 'VALUE'])
+         .compute())
+
+    Parameters
+    ----------
+    table: str
+        name of the table
+    path: str or path, default = current working directory
+        path to the table data
+    h5file: str, default stats_can.h5
+        store to read from, None for zip or a name ending in .parquet for a
+        parquet store
+    """
+
+    def __init__(self, table, path=None, h5file='stats_can.h5'):
+        self.table = parse_tables(table)[0]
+        self.path = path
+        self.h5file = h5file
+        self.columns = None
+        self.filters = {}
+        self.start_date = None
+        self.end_date = None
+        self.limit = None
+        self.aggregation = None
+
+    def __repr__(self):
+        template = 'LazyTable({!r}, columns={!r}, filters={!r}, dates={!r})'
+        return template.format(
+            self.table, self.columns, self.filters,
+            (self.start_date, self.end_date)
+            )
+
+    def _with(self, **changes):
+        lazy = LazyTable.__new__(LazyTable)
+        lazy.__dict__.update(self.__dict__)
+        lazy.filters = dict(self.filters)
+        lazy.__dict__.update(changes)
+        return lazy
+
+    def select(self, columns):
+        """Only read these columns"""
+        return self._with(columns=list(columns))
+
+    def filter(self, column, values):
+        """Only read rows where column is one of values
+
+        Filtering the same column again narrows it to values in both.
+        """
+        if isinstance(values, str) or not hasattr(values, '__iter__'):
+            values = [values]
+        values = list(values)
+        if column == 'VECTOR':
+            values = ['v' + str(v) for v in parse_vectors(values)]
+        if column in self.filters:
+            values = [v for v in values if v in self.filters[column]]
+        filters = dict(self.filters)
+        filters[column] = values
+        return self._with(filters=filters)
+
+    def dates(self, start=None, end=None):
+        """Only read rows with a REF_DATE from start to end, inclusive"""
+        return self._with(
+            start_date=pd.Timestamp(start) if start is not None else None,
+            end_date=pd.Timestamp(end) if end is not None else None
+            )
+
+    def head(self, n=5):
+        """Compute the first n matching rows"""
+        return self._with(limit=n).compute()
+
+    def agg(self, func, by=None, column='VALUE'):
+        """Aggregate column, for each group of by if given
+
+        Parameters
+        ----------
+        func: str, function or list
+            anything pandas' agg accepts, e.g. 'sum' or ['min', 'max']
+        by: str or list of str, optional, default None
+            columns to group by, e.g. 'GEO' or ['REF_DATE', 'GEO']
+        column: str, default VALUE
+            the column to aggregate
+        """
+        return self._with(aggregation=(func, by, column))
+
+    def read_columns(self):
+        """Columns the read needs for the selection, filters and aggregation
+        """
+        if self.columns is None:
+            return None
+        needed = list(self.columns) + list(self.filters)
+        if self.start_date is not None or self.end_date is not None:
+            needed.append('REF_DATE')
+        if self.aggregation:
+            _, by, column = self.aggregation
+            if by is not None:
+                needed += [by] if isinstance(by, str) else list(by)
+            needed.append(column)
+        return list(dict.fromkeys(needed))
+
+    def apply_filters(self, df):
+        """Filter a dataframe of the table's rows"""
+        mask = pd.Series(True, index=df.index)
+        for column, values in self.filters.items():
+            mask &= df[column].isin(values)
+        if self.start_date is not None:
+            mask &= df['REF_DATE'] >= self.start_date
+        if self.end_date is not None:
+            mask &= df['REF_DATE'] <= self.end_date
+        return df[mask]
+
+    def read(self):
+        """Read the selected columns of the matching rows"""
+        columns = self.read_columns()
+        filtered = bool(self.filters) or (
+            self.start_date is not None or self.end_date is not None
+            )
+        if is_parquet_store(self.h5file):
+            filters = [
+                (column, 'in', values)
+                for column, values in self.filters.items()
+                ]
+            if self.start_date is not None:
+                filters.append(('REF_DATE', '>=', self.start_date))
+            if self.end_date is not None:
+                filters.append(('REF_DATE', '<=', self.end_date))
+            df = table_from_parquet(
+                self.table, store=self.h5file, path=self.path,
+                columns=columns, filters=filters or None
+                )
+        elif self.h5file:
+            data_columns = h5_data_columns(
+                self.table, h5file=self.h5file, path=self.path
+                )
+            where = [
+                '{} in {!r}'.format(column, values)
+                for column, values in self.filters.items()
+                if column in data_columns
+                ]
+            if self.start_date is not None:
+                where.append('REF_DATE >= {!r}'.format(str(self.start_date)))
+            if self.end_date is not None:
+                where.append('REF_DATE <= {!r}'.format(str(self.end_date)))
+            stop = None if filtered else self.limit
+            try:
+                df = table_from_h5(
+                    self.table, h5file=self.h5file, path=self.path,
+                    where=where or None, columns=columns, stop=stop
+                    )
+            except ValueError:  # stored without data columns
+                df = table_from_h5(
+                    self.table, h5file=self.h5file, path=self.path,
+                    columns=columns, stop=stop
+                    )
+        else:
+            chunks = []
+            n_rows = 0
+            for chunk in iter_zip_table(self.table, path=self.path):
+                chunk = self.apply_filters(chunk)
+                if columns is not None:
+                    chunk = chunk[columns]
+                chunks.append(chunk)
+                n_rows += len(chunk)
+                if self.limit is not None and n_rows >= self.limit:
+                    break
+            df = concat_categorical_chunks(chunks)
+        df = self.apply_filters(df)
+        if self.limit is not None:
+            df = df.head(self.limit)
+        return df
+
+    def compute(self):
+        """Read the table and apply everything that's been added
+
+        Returns
+        -------
+        pd.DataFrame or pd.Series
+            the selected columns of the matching rows, or the aggregation
+            if one was added
+        """
+        df = self.read()
+        if self.aggregation:
+            func, by, column = self.aggregation
+            if by is None:
+                return df[column].agg(func)
+            return df.groupby(by, observed=True)[column].agg(func)
+        if self.columns is not None:
+            df = df[self.columns]
+        return df.reset_index(drop=True)
+
+
 def vectors_to_df(
-    vectors, periods=1, start_release_date=None, end_release_date=None
+    vectors, periods=1, start_release_date=None, end_release_date=None,
+    long_format=False, dtype=None
 ):
     """data frame of vectors with n periods data or over range of release dates
 
@@ -568,6 +2697,9 @@ def vectors_to_df(
     get_data_from_vectors_and_latest_n_periods function to turn the resulting
     list of JSONs into a DataFrame
 
+    The data points are flattened into column arrays in one pass and the
+    frame is built once at the end.
+
     Parameters
     ----------
     vectors: str or list of str
@@ -578,13 +2710,17 @@ def vectors_to_df(
         start release date for the data
     end_release_date: datetime.date
         end release date for the data
+    long_format: boolean, default False
+        return a long frame with refPer, vector and value columns, one row
+        per data point, instead of a vector per column
+    dtype: numpy dtype, optional, default None
+        dtype for the values, e.g. np.float32 to halve memory, float64 if None
 
     Returns
     -------
     df: DataFrame
         vectors as columns and ref_date as the index (not release date)
     """
-    df = pd.DataFrame()
     if ((end_release_date is None) | (start_release_date is None)):
         start_list = get_data_from_vectors_and_latest_n_periods(
             vectors, periods
@@ -593,21 +2729,102 @@ def vectors_to_df(
         start_list = get_bulk_vector_data_by_range(
             vectors, start_release_date, end_release_date
             )
-    for vec in start_list:
-        name = "v" + str(vec['vectorId'])
-        ser = (
-            pd.DataFrame(vec['vectorDataPoint'])
-            .assign(refPer=lambda x: pd.to_datetime(x['refPer']))
-            .set_index('refPer')
-            .rename(columns={'value': name})
-            .filter([name])
-        )
-        df = pd.concat([df, ser], axis=1, sort=True)
+    dtype = np.dtype(dtype or np.float64)
+    names = ["v" + str(vec['vectorId']) for vec in start_list]
+    counts = [len(vec['vectorDataPoint']) for vec in start_list]
+    size = sum(counts)
+    ref_pers = np.empty(size, dtype=object)
+    values = np.empty(size, dtype=dtype)
+    start = 0
+    for vec, count in zip(start_list, counts):
+        points = vec['vectorDataPoint']
+        ref_pers[start:start + count] = [p['refPer'] for p in points]
+        # None for missing values comes through as NaN
+        values[start:start + count] = np.array(
+            [p['value'] for p in points], dtype=float
+            )
+        start += count
+    unique_names = list(dict.fromkeys(names))
+    long_df = pd.DataFrame({
+        'refPer': pd.to_datetime(ref_pers),
+        'vector': pd.Categorical(
+            np.repeat(names, counts), categories=unique_names
+            ),
+        'value': values
+        })
+    if long_format:
+        return long_df
+    df = (
+        long_df
+        .drop_duplicates(['refPer', 'vector'], keep='last')
+        .pivot(index='refPer', columns='vector', values='value')
+        .reindex(columns=unique_names)
+    )
+    df.columns = list(df.columns)  # remove categorical index
+    return df
+
+
+def local_table_vectors(
+    table, vectors, path=None, start_date=None, h5file='stats_can.h5'
+):
+    """Load some vectors from one local table as date indexed columns
+
+    Used by vectors_to_df_local, kept at module level so it can run in a
+    process pool.
+
+    Parameters
+    ----------
+    table: str
+        table the vectors are in
+    vectors: list of str
+        vectors to read, as 'v' followed by the vector number
+    path: str or os path, default None
+        path to StatsCan tables
+    start_date: numpy.datetime64, optional, default None
+        optional earliest reference date to include
+    h5file: str, default stats_can.h5
+        store to read from, see vectors_to_df_local
+
+    Returns
+    -------
+    df: pd.DataFrame
+        a column for each vector, indexed on REF_DATE
+    """
+    columns = ['REF_DATE', 'VECTOR', 'VALUE']
+    # Push the filters down to the read so only matching rows come off
+    # disk, they're applied again below for zips and older h5 tables
+    if is_parquet_store(h5file):
+        filters = [('VECTOR', 'in', vectors)]
+        if start_date is not None:
+            filters.append(('REF_DATE', '>=', pd.Timestamp(start_date)))
+        df = table_from_parquet(
+            table, store=h5file, path=path, columns=columns, filters=filters
+            )
+    elif h5file:
+        where = ['VECTOR in {!r}'.format(vectors)]
+        if start_date is not None:
+            where.append(
+                'REF_DATE >= {!r}'.format(str(pd.Timestamp(start_date)))
+                )
+        try:
+            df = table_from_h5(
+                table, h5file=h5file, path=path, where=where, columns=columns
+                )
+        except ValueError:  # stored without data columns
+            df = table_from_h5(table, h5file=h5file, path=path)[columns]
+    else:
+        df = zip_table_to_dataframe(table, path)[columns]
+    df = df[df['VECTOR'].isin(vectors)]
+    if start_date is not None:
+        df = df[df['REF_DATE'] >= start_date]
+    df = df.pivot(index='REF_DATE', columns='VECTOR', values='VALUE')
+    df.columns = list(df.columns)  # remove categorical index
     return df
 
 
 def vectors_to_df_local(
-    vectors, path=None, start_date=None, h5file='stats_can.h5'
+    vectors, path=None, start_date=None, h5file='stats_can.h5',
+    max_workers=1
 ):
     """Make a dataframe with vector columns indexed on date from local data
 
@@ -621,54 +2838,217 @@ def vectors_to_df_local(
         optional earliest reference date to include
     h5file: str, default stats_can.h5
         if specified will extract dataframes from an hdf5file instead of
-        zipped csv tables
+        zipped csv tables, or from a parquet store if it ends in .parquet
+    max_workers: int, default 1
+        number of processes to load and pivot tables in, 1 loads them one
+        after another in this process
     
     """
     # Preserve an initial copy of the list for ordering, parsed and then
     # converted to string for consistency in naming
     vectors_ordered = parse_vectors(vectors)
     vectors_ordered = ['v' + str(v) for v in vectors_ordered]
-    table_vec_dict = table_subsets_from_vectors(vectors)
+    table_vec_dict = table_subsets_from_vectors(vectors, path=path)
     tables = list(table_vec_dict.keys())
-    tables_dfs = {}
-    columns = ['REF_DATE', 'VECTOR', 'VALUE']
-    if h5file:
-        meta = metadata_from_h5(
-            tables,
-            h5file=h5file,
-            path=path
-        )
-        existing_tables = [t['productId'] for t in meta]
+    if h5file and not is_parquet_store(h5file):
+        existing_tables = [
+            t['productId'] for t in h5_catalog(h5file=h5file, path=path)
+            ]
         to_download_tables = list(set(tables) - set(existing_tables))
-        tables_to_h5(
-            to_download_tables,
-            h5file=h5file,
-            path=path
-            )
-    for table in tables:
-        if h5file:
-            tables_dfs[table] = table_from_h5(
-                table, h5file=h5file, path=path
-                )[columns]
-        else:
-            tables_dfs[table] = zip_table_to_dataframe(table, path)[columns]
-        df = tables_dfs[table]  # save me some typing
-        vec_list = ['v' + str(v) for v in table_vec_dict[table]]
-        df = df[df['VECTOR'].isin(vec_list)]
-        if start_date is not None:
-            start_date = np.datetime64(start_date)
-            df = df[df['REF_DATE'] >= start_date]
-        df = df.pivot(index='REF_DATE', columns='VECTOR', values='VALUE')
-        df.columns = list(df.columns)  # remove categorical index
-        tables_dfs[table] = df
-    final_df = tables_dfs[tables[0]]
-    for table in tables[1:]:
-        final_df = pd.merge(
-            final_df, tables_dfs[table],
-            how='outer',
-            left_index=True, right_index=True
-            )
+        if to_download_tables:
+            tables_to_h5(
+                to_download_tables,
+                h5file=h5file,
+                path=path
+                )
+    if start_date is not None:
+        start_date = np.datetime64(start_date)
+    vec_lists = [
+        ['v' + str(v) for v in table_vec_dict[table]] for table in tables
+        ]
+    n_tables = len(tables)
+    args = (
+        tables, vec_lists, [path] * n_tables, [start_date] * n_tables,
+        [h5file] * n_tables
+        )
+    if max_workers > 1 and n_tables > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, n_tables)
+        ) as executor:
+            tables_dfs = list(executor.map(local_table_vectors, *args))
+    else:
+        tables_dfs = list(map(local_table_vectors, *args))
+    # Align every table on one union of dates rather than merging in pairs
+    final_df = pd.concat(tables_dfs, axis=1, join='outer', sort=True)
     final_df = final_df[vectors_ordered]
     return final_df
 
 
+def aggregate_block(source, start, stop, by, value='VALUE', date_freq=None):
+    """Partly aggregate one block of a stored table
+
+    Used by aggregate_table, kept at module level so it can run in a
+    process pool.
+
+    Parameters
+    ----------
+    source: tuple
+        ('h5', h5 file, key) or ('parquet', parquet file, None) to read the
+        block from, or ('frame', dataframe, None) for a block already read
+    start: int
+        first row of the block for h5, the row group for parquet
+    stop: int
+        row after the last of the block for h5, ignored otherwise
+    by: list of str
+        columns to group by
+    value: str, default VALUE
+        column to aggregate
+    date_freq: str, optional, default None
+        pandas period frequency to group REF_DATE by, e.g. 'Y' or 'Q'
+
+    Returns
+    -------
+    pd.DataFrame
+        sum, count, min and max of value for each group in the block
+    """
+    kind, location, key = source
+    columns = list(dict.fromkeys(by + [value]))
+    with stage('aggregate_block', kind=kind) as metrics:
+        if kind == 'h5':
+            with store_lock(location):
+                df = pd.read_hdf(
+                    location, key=key, start=start, stop=stop, columns=columns
+                    )
+        elif kind == 'parquet':
+            df = pq.ParquetFile(location).read_row_group(
+                start, columns=columns
+                ).to_pandas()
+        else:
+            df = location[columns]
+        keys = [df[col] for col in by]
+        if date_freq and 'REF_DATE' in by:
+            keys[by.index('REF_DATE')] = (
+                df['REF_DATE'].dt.to_period(date_freq)
+                )
+        partial = df.groupby(keys, observed=True)[value].agg(
+            ['sum', 'count', 'min', 'max']
+            )
+        metrics.add(rows=len(df))
+    return partial
+
+
+def merge_aggregates(partials):
+    """Combine partial aggregates from aggregate_block
+
+    Parameters
+    ----------
+    partials: list of pd.DataFrame
+        partial aggregates over the same groupings
+
+    Returns
+    -------
+    pd.DataFrame
+        sum, count, min and max for each group across the partials
+    """
+    combined = pd.concat(partials)
+    levels = list(range(combined.index.nlevels))
+    return combined.groupby(level=levels, observed=True).agg(
+        {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'}
+        )
+
+
+def aggregate_table(
+    table, by, path=None, h5file='stats_can.h5', value='VALUE',
+    date_freq=None, chunksize=ZIP_READ_CHUNK_ROWS, max_workers=1
+):
+    """Group a stored table without loading it whole
+
+    The table is read in blocks of rows, each block is reduced to the sum,
+    count, min and max of value for its groups, and those partial results
+    are merged as they arrive. Only a few blocks and one row per group are
+    held in memory at once, however long the table is.
+
+    Example, yearly totals by geography:
+        aggregate_table('18100004', by=['GEO', 'REF_DATE'], date_freq='Y')
+
+    Parameters
+    ----------
+    table: str
+        the table to aggregate, loaded into the store first if needed
+    by: str or list of str
+        columns to group by
+    path: str or path, default = current working directory
+        path to the table data
+    h5file: str, default stats_can.h5
+        store to read from, None for zip or a name ending in .parquet for a
+        parquet store
+    value: str, default VALUE
+        column to aggregate
+    date_freq: str, optional, default None
+        pandas period frequency to group REF_DATE by if it's in by, e.g.
+        'Y' for years or 'Q' for quarters
+    chunksize: int, default ZIP_READ_CHUNK_ROWS
+        rows per block for h5 stores and zips, parquet stores are read a row
+        group at a time
+    max_workers: int, default 1
+        number of processes to aggregate blocks in, 1 works through them
+        one after another in this process
+
+    Returns
+    -------
+    pd.DataFrame
+        sum, count, min, max and mean of value, indexed by the groups
+    """
+    table = parse_tables(table)[0]
+    by = [by] if isinstance(by, str) else list(by)
+    blocks = []
+    if is_parquet_store(h5file):
+        data_file, _ = parquet_store_files(table, h5file, path)
+        if not os.path.isfile(data_file):
+            tables_to_parquet(tables=table, store=h5file, path=path)
+        source = ('parquet', data_file, None)
+        n_groups = pq.ParquetFile(data_file).num_row_groups
+        blocks = [(source, i, None) for i in range(n_groups)]
+    elif h5file:
+        hkey = 'table_' + table
+        h5 = os.path.join(path, h5file) if path else h5file
+        if table not in [t['productId'] for t in h5_catalog(h5file, path)]:
+            tables_to_h5(tables=table, h5file=h5file, path=path)
+        with store_lock(h5), pd.HDFStore(h5, 'r') as store:
+            nrows = store.get_storer(hkey).nrows
+        source = ('h5', h5, hkey)
+        blocks = [
+            (source, start, min(start + chunksize, nrows))
+            for start in range(0, nrows, chunksize)
+            ]
+    else:
+        blocks = (
+            (('frame', chunk, None), 0, None)
+            for chunk in iter_zip_table(table, path, chunksize=chunksize)
+            )
+    def merge(merged, partial):
+        if merged is None:
+            return partial
+        return merge_aggregates([merged, partial])
+
+    merged = None
+    args = (by, value, date_freq)
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = []
+            for block in blocks:
+                pending.append(executor.submit(aggregate_block, *block, *args))
+                # Bound the blocks waiting on a worker, zips are read ahead
+                if len(pending) >= 2 * max_workers:
+                    merged = merge(merged, pending.pop(0).result())
+            for future in pending:
+                merged = merge(merged, future.result())
+    else:
+        for block in blocks:
+            merged = merge(merged, aggregate_block(*block, *args))
+    if merged is None:
+        merged = pd.DataFrame(columns=['sum', 'count', 'min', 'max'])
+    merged['mean'] = merged['sum'] / merged['count']
+    if h5file and not is_parquet_store(h5file):
+        h5_record_access(h5, [table])
+    return merged
@@ -12,48 +12,240 @@ Attributes
 ----------
 SC_URL : str
     URL for the Statistics Canada REST api
+SESSION : requests.Session or None
+    shared session used for every api call, built on first use by
+    get_session. Replace it with set_session to inject your own
+RETRY_STATUSES : tuple of int
+    HTTP status codes that are retried with backoff
+MAX_IN_FLIGHT : int
+    default number of vector chunks to request at once when CONTROLLER is
+    None. Keep it at or below the session pool size and inside StatsCan's
+    rate limits
+CONTROLLER : AdaptiveController or None
+    shared controller every api call goes through, adapting vector chunk
+    size and concurrency to how the server responds. Vector requests hand
+    it up to its max_concurrency chunks at once and it decides how many
+    run. Set to None to turn it off
 
 TODO
 ----
 Missing api implementations:
     GetSeriesInfoFromCubePidCoord
-    GetChangedSeriesDataFromCubePidCoord
-    GetChangedSeriesDataFromVector
     GetDataFromCubePidCoordAndLatestNPeriods
     GetFullTableDownloadSDMX
     GetCodeSets
 """
+import time
 import datetime as dt
-import requests
-# from stats_can.helpers import check_status, parse_tables, chunk_vectors
+# Imported as part of the package these come from helpers, run with
+# %run -i after helpers.py they're already defined
+try:
+    from .helpers import check_status, parse_tables, chunk_vectors
+    from .helpers import dispatch_chunks, AdaptiveController, stage
+    from .helpers import dispatch_adaptive, LazyModule
+except ImportError:
+    pass
+
+# Imported the first time a session is made, so importing sc doesn't pay
+# for requests and urllib3
+requests = LazyModule('requests')
+urllib3_retry = LazyModule('urllib3.util.retry')
 
 
 SC_URL = 'https://www150.statcan.gc.ca/t1/wds/rest/'
+SESSION = None
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_IN_FLIGHT = 1
+CONTROLLER = AdaptiveController()
+
+
+def make_session(pool_size=10, retries=5, backoff_factor=0.5):
+    """Build a requests session set up for the StatsCan api
+
+    The session keeps connections alive in a pool so repeated calls skip the
+    TCP and TLS handshake, asks for gzip encoded responses, and retries
+    throttled or failed requests with exponential backoff, honouring any
+    Retry-After header the server sends.
+
+    Parameters
+    ----------
+    pool_size: int, default 10
+        number of connections to keep open per host
+    retries: int, default 5
+        how many times to retry a request before giving up
+    backoff_factor: float, default 0.5
+        sleep between retries is backoff_factor * 2 ** (retry number - 1)
+
+    Returns
+    -------
+    session: requests.Session
+        configured session
+    """
+    # Every POST to the api is a read so it's safe to retry on any method
+    retry = urllib3_retry.Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,
+        raise_on_status=False
+        )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry
+        )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    return session
+
+
+def get_session(session=None):
+    """Return the session to make api calls with
+
+    Parameters
+    ----------
+    session: requests.Session, optional, default None
+        if passed it is returned as is, otherwise the module session is used,
+        building it with make_session the first time
+
+    Returns
+    -------
+    session: requests.Session
+    """
+    global SESSION
+    if session is not None:
+        return session
+    if SESSION is None:
+        SESSION = make_session()
+    return SESSION
+
+
+def set_session(session):
+    """Replace the module session used by every api call
+
+    Parameters
+    ----------
+    session: requests.Session or None
+        session to use from now on, None resets to a default session on the
+        next call
+    """
+    global SESSION
+    SESSION = session
+
+
+def api_request(session, method, url, **kwargs):
+    """Make an api request through CONTROLLER, measured as an 'api' stage
+
+    Parameters
+    ----------
+    session: requests.Session
+        session to make the request with
+    method: str
+        HTTP method
+    url: str
+        where to send the request
+    **kwargs
+        passed on to session.request
+
+    Returns
+    -------
+    result: requests.Response
+    """
+    endpoint = url[len(SC_URL):].split('/')[0]
+    with stage('api', endpoint=endpoint) as metrics:
+        if CONTROLLER is None:
+            result = session.request(method, url, **kwargs)
+        else:
+            with CONTROLLER.slot():
+                start = time.monotonic()
+                result = session.request(method, url, **kwargs)
+                CONTROLLER.record(result, time.monotonic() - start)
+        retries = getattr(result.raw, 'retries', None)
+        metrics.add(
+            bytes=len(result.content),
+            retries=len(getattr(retries, 'history', ()))
+            )
+    return result
+
+
+def vector_chunks(vectors):
+    """Split vectors into chunks sized by CONTROLLER
+
+    Parameters
+    ----------
+    vectors: str or list of str
+        vector numbers to split up
+
+    Returns
+    -------
+    list of lists of int
+        lists of vectors in chunks
+    """
+    chunk_size = CONTROLLER.chunk_size if CONTROLLER is not None else None
+    return chunk_vectors(vectors, chunk_size)
 
 
-def get_changed_series_list():
+def dispatch_vectors(func, vectors, max_in_flight=None):
+    """Call func on chunks of vectors, resized as CONTROLLER adapts
+
+    Parameters
+    ----------
+    func : callable
+        function taking one chunk of vectors and returning a list of results
+    vectors: str or list of str
+        vector numbers to split up
+    max_in_flight: int, optional, default None
+        most chunks to request at once. Defaults to CONTROLLER's
+        max_concurrency, its slots then limit how many actually run, or to
+        MAX_IN_FLIGHT without a controller
+
+    Returns
+    -------
+    list
+        results of every call joined together in the same order as vectors
+    """
+    if CONTROLLER is None:
+        return dispatch_chunks(
+            func, vector_chunks(vectors), max_in_flight or MAX_IN_FLIGHT
+            )
+    return dispatch_adaptive(
+        func, vectors, lambda: CONTROLLER.chunk_size,
+        max_in_flight or CONTROLLER.max_concurrency
+        )
+
+
+def get_changed_series_list(session=None):
     """https://www.statcan.gc.ca/eng/developers/wds/user-guide#a10-1
 
     Gets all series that were updated today.
 
+    Parameters
+    ----------
+    session: requests.Session, optional, default None
+        session to make the request with, defaults to the module session
+
     Returns
     -------
     list of dicts
         one for each vector and when it was released
     """
     url = SC_URL + 'getChangedSeriesList'
-    result = requests.get(url)
+    result = api_request(get_session(session), 'get', url)
     result = check_status(result)
     return result['object']
 
 
-def get_changed_cube_list(date=None):
+def get_changed_cube_list(date=None, session=None):
     """https://www.statcan.gc.ca/eng/developers/wds/user-guide#a10-2
 
     Parameters
     ----------
     date : datetime.date
         Date to check for table changes, defaults to current date
+    session: requests.Session, optional, default None
+        session to make the request with, defaults to the module session
 
     Returns
     -------
@@ -63,12 +255,12 @@ def get_changed_cube_list(date=None):
     if not date:
         date = dt.date.today()
     url = SC_URL + 'getChangedCubeList' + '/' + str(date)
-    result = requests.get(url)
+    result = api_request(get_session(session), 'get', url)
     result = check_status(result)
     return result['object']
 
 
-def get_cube_metadata(tables):
+def get_cube_metadata(tables, session=None):
     """https://www.statcan.gc.ca/eng/developers/wds/user-guide#a11-1
 
     Take a list of tables and return a list of dictionaries with their
@@ -78,6 +270,8 @@ def get_cube_metadata(tables):
     ----------
     tables : str or list of str
         IDs of tables to get metadata for
+    session: requests.Session, optional, default None
+        session to make the request with, defaults to the module session
 
     Returns
     -------
@@ -87,7 +281,9 @@ def get_cube_metadata(tables):
     tables = parse_tables(tables)
     tables = [{'productId': t} for t in tables]
     url = SC_URL + 'getCubeMetadata'
-    result = requests.post(url, json=tables)
+    result = api_request(
+        get_session(session), 'post', url, json=tables
+        )
     result.raise_for_status()
     result = check_status(result)
     return [r['object'] for r in result]
@@ -100,41 +296,96 @@ def get_series_info_from_cube_pid_coord():
     pass
 
 
-def get_series_info_from_vector(vectors):
+def get_series_info_from_vector(vectors, session=None, max_in_flight=None):
     """https://www.statcan.gc.ca/eng/developers/wds/user-guide#a11-3
 
     Parameters
     ----------
     vectors: str or list of str
         vector numbers to get info for
+    session: requests.Session, optional, default None
+        session to make the request with, defaults to the module session
+    max_in_flight: int, optional, default None
+        most chunks of vectors to request at once, see dispatch_vectors.
+        Results come back in input order either way
 
     Returns
     -------
     List of dicts containing metadata for each v#
     """
     url = SC_URL + 'getSeriesInfoFromVector'
-    chunks = chunk_vectors(vectors)
-    final_list = []
-    for chunk in chunks:
+    session = get_session(session)
+
+    def post_chunk(chunk):
+        """Request info for one chunk of vectors"""
         vectors = [{'vectorId': v} for v in chunk]
-        result = requests.post(url, json=vectors)
+        result = api_request(session, 'post', url, json=vectors)
         result = check_status(result)
-        final_list += result
-    return [r['object'] for r in final_list]
+        return [r['object'] for r in result]
+    return dispatch_vectors(post_chunk, vectors, max_in_flight)
 
 
-def get_changed_series_data_from_cube_pid_coord():
-    """ Not implemented yet
+def get_changed_series_data_from_cube_pid_coord(
+        table, coordinates, session=None
+):
+    """https://www.statcan.gc.ca/eng/developers/wds/user-guide#a12-1
 
-    https://www.statcan.gc.ca/eng/developers/wds/user-guide#a12-1"""
-    pass
+    Data points released today for series identified by table and coordinate
 
+    Parameters
+    ----------
+    table: str
+        table the series belong to
+    coordinates: str or list of str
+        coordinates of the series in the table, e.g. '1.12.0.0.0.0.0.0.0.0'
+    session: requests.Session, optional, default None
+        session to make the request with, defaults to the module session
 
-def get_changed_series_data_from_vector():
-    """ Not implemented yet
+    Returns
+    -------
+    List of dicts containing the changed data points for each series
+    """
+    url = SC_URL + 'getChangedSeriesDataFromCubePidCoord'
+    table = int(parse_tables(table)[0])
+    if isinstance(coordinates, str):
+        coordinates = [coordinates]
+    json = [{'productId': table, 'coordinate': c} for c in coordinates]
+    result = api_request(get_session(session), 'post', url, json=json)
+    result = check_status(result)
+    return [r['object'] for r in result]
 
-    https://www.statcan.gc.ca/eng/developers/wds/user-guide#a12-2"""
-    pass
+
+def get_changed_series_data_from_vector(
+        vectors, session=None, max_in_flight=None
+):
+    """https://www.statcan.gc.ca/eng/developers/wds/user-guide#a12-2
+
+    Data points released today for a list of vectors
+
+    Parameters
+    ----------
+    vectors: str or list of str
+        vector numbers to get changed data for, they must have changed today
+    session: requests.Session, optional, default None
+        session to make the request with, defaults to the module session
+    max_in_flight: int, optional, default None
+        most chunks of vectors to request at once, see dispatch_vectors.
+        Results come back in input order either way
+
+    Returns
+    -------
+    List of dicts containing the changed data points for each vector
+    """
+    url = SC_URL + 'getChangedSeriesDataFromVector'
+    session = get_session(session)
+
+    def post_chunk(chunk):
+        """Request changed data for one chunk of vectors"""
+        vectors = [{'vectorId': v} for v in chunk]
+        result = api_request(session, 'post', url, json=vectors)
+        result = check_status(result)
+        return [r['object'] for r in result]
+    return dispatch_vectors(post_chunk, vectors, max_in_flight)
 
 
 def get_data_from_cube_pid_coord_and_latest_n_periods():
@@ -145,7 +396,9 @@ def get_data_from_cube_pid_coord_and_latest_n_periods():
     pass
 
 
-def get_data_from_vectors_and_latest_n_periods(vectors, periods):
+def get_data_from_vectors_and_latest_n_periods(
+        vectors, periods, session=None, max_in_flight=None
+):
     """ https://www.statcan.gc.ca/eng/developers/wds/user-guide#a12-4
 
     Parameters
@@ -154,27 +407,34 @@ def get_data_from_vectors_and_latest_n_periods(vectors, periods):
         vector numbers to get info for
     periods: int
         number of periods (starting at latest) to retrieve data for
+    session: requests.Session, optional, default None
+        session to make the request with, defaults to the module session
+    max_in_flight: int, optional, default None
+        most chunks of vectors to request at once, see dispatch_vectors.
+        Results come back in input order either way
 
     Returns
     -------
     List of dicts containing data for each vector
     """
     url = SC_URL + 'getDataFromVectorsAndLatestNPeriods'
-    chunks = chunk_vectors(vectors)
-    final_list = []
-    for chunk in chunks:
+    session = get_session(session)
+
+    def post_chunk(chunk):
+        """Request the latest periods for one chunk of vectors"""
         periods_l = [periods for i in range(len(chunk))]
         json = [
             {'vectorId': v, 'latestN': n} for v, n in zip(chunk, periods_l)
             ]
-        result = requests.post(url, json=json)
+        result = api_request(session, 'post', url, json=json)
         result = check_status(result)
-        final_list += [r['object'] for r in result]
-    return final_list
+        return [r['object'] for r in result]
+    return dispatch_vectors(post_chunk, vectors, max_in_flight)
 
 
 def get_bulk_vector_data_by_range(
-        vectors, start_release_date, end_release_date
+        vectors, start_release_date, end_release_date, session=None,
+        max_in_flight=None
 ):
     """https://www.statcan.gc.ca/eng/developers/wds/user-guide#a12-5
     
@@ -186,6 +446,11 @@ def get_bulk_vector_data_by_range(
         start release date for the data
     end_release_date: datetime.date
         end release date for the data
+    session: requests.Session, optional, default None
+        session to make the request with, defaults to the module session
+    max_in_flight: int, optional, default None
+        most chunks of vectors to request at once, see dispatch_vectors.
+        Results come back in input order either way
 
     Returns
     -------
@@ -194,11 +459,12 @@ def get_bulk_vector_data_by_range(
     url = SC_URL + 'getBulkVectorDataByRange'
     start_release_date = str(start_release_date) + "T13:00"
     end_release_date = str(end_release_date) + "T13:00"
-    chunks = chunk_vectors(vectors)
-    final_list = []
-    for vector_ids in chunks:
-        result = requests.post(
-            url,
+    session = get_session(session)
+
+    def post_chunk(vector_ids):
+        """Request the release date range for one chunk of vectors"""
+        result = api_request(
+            session, 'post', url,
             json={
                 "vectorIds": vector_ids,
                 "startDataPointReleaseDate": start_release_date,
@@ -206,11 +472,11 @@ def get_bulk_vector_data_by_range(
                 }
             )
         result = check_status(result)
-        final_list += [r['object'] for r in result]
-    return final_list
+        return [r['object'] for r in result]
+    return dispatch_vectors(post_chunk, vectors, max_in_flight)
 
 
-def get_full_table_download(table, csv=True):
+def get_full_table_download(table, csv=True, session=None):
     """https://www.statcan.gc.ca/eng/developers/wds/user-guide#a12-6
     https://www.statcan.gc.ca/eng/developers/wds/user-guide#a12-7
 
@@ -222,6 +488,8 @@ def get_full_table_download(table, csv=True):
         table name to download
     csv: boolean, default True
         download in CSV format, if not download SDMX
+    session: requests.Session, optional, default None
+        session to make the request with, defaults to the module session
 
     Returns
     -------
@@ -233,7 +501,7 @@ def get_full_table_download(table, csv=True):
         url = SC_URL + 'getFullTableDownloadCSV/' + table + '/en'
     else:
         url = SC_URL + 'getFullTableDownloadSDMX/' + table
-    result = requests.get(url)
+    result = api_request(get_session(session), 'get', url)
     result = check_status(result)
     return result['object']
 